@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# Offline benchmark of CLEO's extraction engine over the labelled mails in corpus.json.
+#
+#   python benchmarks/benchmark.py                  run and compare against baseline.json
+#   python benchmarks/benchmark.py --save           run and make this the new baseline
+#   python benchmarks/benchmark.py --repeat 20      more passes for steadier numbers
+#   python benchmarks/benchmark.py --throughput-tolerance 0.15
+#                                                   also fail when throughput drops more than 15%
+#
+# Every fixture is turned into a gmail api message and taken through parseMessage, the relevance
+# filter, extractDateTime and extractLocation, the same path a fetched mail takes before Gemini.
+# Nothing here talks to the network. Exits with 1 when accuracy regressed. Timings are only
+# reported, the baseline's were taken on whatever machine saved it, so gating on them is left to
+# --throughput-tolerance on a machine that saved its own baseline.
+# That extractDateTimeParallel matches extractDateTime is checked in tests/test_extraction.py
+
+import os.path
+import sys
+import json
+import base64
+import tracemalloc
+from time import perf_counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import main as cleo
+
+CORPUS_FILE = os.path.join(HERE, "corpus.json")
+BASELINE_FILE = os.path.join(HERE, "baseline.json")
+
+# throughput may drop this much against the baseline before it counts as a regression,
+# None reports it without gating. Accuracy has no tolerance
+THROUGHPUT_TOLERANCE = None
+
+FIELDS = ['startdate', 'enddate', 'starttime', 'endtime', 'location']
+
+def loadCorpus(path = CORPUS_FILE):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def toMessage(fixture):
+
+    # the fixture as messages().get would return it
+
+    data = base64.urlsafe_b64encode(fixture['body'].encode()).decode().rstrip('=')
+
+    return {
+        'id': fixture['id'],
+        'payload': {
+            'mimeType': fixture['mimeType'],
+            'headers': [
+                {'name': 'From', 'value': fixture['from']},
+                {'name': 'Subject', 'value': fixture['subject']},
+                {'name': 'Date', 'value': fixture['date']}
+            ],
+            'body': {'data': data}
+        }
+    }
+
+def process(message, relevance):
+
+    # one mail through every offline stage. Mails the filter would skip are still extracted
+    # so extraction accuracy is measured on its own, the verdict is returned next to the mail
+
+    mail = cleo.parseMessage(message)
+    relevant = relevance.relevant(mail)
+
+    cleo.extractDateTime([mail])
+    mail.location = cleo.extractLocation(mail.excerpt)
+
+    return mail, relevant
+
+def actual(mail):
+    # extracted fields in the same form as the labels
+    return {
+        'startdate': mail.startdate and mail.startdate.isoformat(),
+        'enddate': mail.enddate and mail.enddate.isoformat(),
+        'starttime': mail.starttime and mail.starttime.strftime('%H:%M'),
+        'endtime': mail.endtime and mail.endtime.strftime('%H:%M'),
+        'location': mail.location
+    }
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+def timeRuns(messages, repeat):
+
+    # per mail latencies over repeat passes, the date cache is cleared before
+    # each pass so every pass pays for dateparser like a fresh process does
+
+    latencies = []
+    total = 0.0
+
+    for _ in range(repeat):
+        cleo.cachedParseDate.cache_clear()
+        relevance = cleo.RelevanceFilter()
+
+        for message in messages:
+            start = perf_counter()
+            process(message, relevance)
+            elapsed = perf_counter() - start
+
+            latencies.append(elapsed)
+            total += elapsed
+
+    return latencies, total
+
+def peakMemory(messages):
+    cleo.cachedParseDate.cache_clear()
+    relevance = cleo.RelevanceFilter()
+
+    tracemalloc.start()
+    results = [process(message, relevance) for message in messages]
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return peak, results
+
+def score(corpus, results):
+
+    # accuracy per field over the event mails, plus how well the filter told events apart
+
+    correct = {field: 0 for field in FIELDS}
+    exact = 0
+    events = 0
+    filtered = 0
+    misses = []
+
+    for fixture, (mail, relevant) in zip(corpus, results):
+
+        if relevant == fixture['event']:
+            filtered += 1
+        else:
+            misses.append((fixture['id'], ['relevance'], relevant))
+
+        if not fixture['event']:
+            continue
+
+        events += 1
+        got = actual(mail)
+        wrong = [field for field in FIELDS if got[field] != fixture['expected'][field]]
+
+        for field in FIELDS:
+            if field not in wrong:
+                correct[field] += 1
+
+        if wrong:
+            misses.append((fixture['id'], wrong, got))
+        else:
+            exact += 1
+
+    accuracy = {field: correct[field] / events for field in FIELDS}
+    accuracy['exact'] = exact / events
+    accuracy['filter'] = filtered / len(corpus)
+
+    return accuracy, misses
+
+def run(corpus, repeat):
+
+    messages = [toMessage(fixture) for fixture in corpus]
+
+    # warm up imports and compiled regexes
+    timeRuns(messages[:1], 1)
+
+    latencies, total = timeRuns(messages, repeat)
+    peak, results = peakMemory(messages)
+    accuracy, misses = score(corpus, results)
+
+    report = {
+        'mails': len(corpus),
+        'repeat': repeat,
+        'throughput': len(latencies) / total,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_kb': peak / 1024,
+        'accuracy': accuracy
+    }
+
+    return report, misses
+
+def compare(report, baseline, tolerance = THROUGHPUT_TOLERANCE):
+
+    # lines describing every change against the baseline, and whether any is a regression
+
+    lines = []
+    regressed = False
+
+    ratio = report['throughput'] / baseline['throughput']
+    slower = tolerance is not None and ratio < 1 - tolerance
+    regressed |= slower
+    lines.append(f"throughput {ratio - 1:+.1%}" + (" REGRESSION" if slower else ""))
+
+    for key in ('p50_ms', 'p99_ms', 'peak_kb'):
+        if baseline.get(key):
+            lines.append(f"{key} {report[key] / baseline[key] - 1:+.1%}")
+
+    for field, value in report['accuracy'].items():
+        before = baseline['accuracy'].get(field)
+
+        if before is None or value == before:
+            continue
+
+        worse = value < before
+        regressed |= worse
+        lines.append(f"{field} accuracy {before:.1%} -> {value:.1%}" + (" REGRESSION" if worse else ""))
+
+    return lines, regressed
+
+def main():
+
+    repeat = int(cleo.argValue('--repeat', 5))
+    tolerance = cleo.argValue('--throughput-tolerance', THROUGHPUT_TOLERANCE)
+    tolerance = None if tolerance is None else float(tolerance)
+    save = '--save' in sys.argv
+
+    corpus = loadCorpus()
+    report, misses = run(corpus, repeat)
+
+    print("-" * 80)
+    print(f"{report['mails']} mails x {report['repeat']} passes")
+    print(f"throughput  {report['throughput']:.1f} mails/s")
+    print(f"latency     p50 {report['p50_ms']:.2f} ms, p99 {report['p99_ms']:.2f} ms")
+    print(f"peak memory {report['peak_kb']:.0f} KiB")
+    print("accuracy    " + ", ".join(f"{field} {value:.0%}" for field, value in report['accuracy'].items()))
+
+    for fixture_id, wrong, got in misses:
+        print(f"  {fixture_id}: wrong {', '.join(wrong)} (got {got})")
+
+    failed = False
+
+    if save:
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(report, f, indent = 2)
+        print(f"saved baseline to {BASELINE_FILE}")
+
+    elif os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, 'r') as f:
+            baseline = json.load(f)
+
+        lines, regressed = compare(report, baseline, tolerance)
+        failed |= regressed
+
+        print("vs baseline " + ", ".join(lines))
+
+    else:
+        print("no baseline yet, run with --save to record one")
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the parts of Gmail, Calendar and Gemini that CLEO talks to, for load
+# testing and profiling whole cycles without a Google account or any quota.
+#
+#   python benchmarks/fakeserver.py --mails 10000                    synthetic mailbox
+#   python benchmarks/fakeserver.py --latency 0.05 --error-rate 0.02 slow and flaky upstream
+#   python benchmarks/fakeserver.py --arrival-rate 2                 new mail every half second
+#   python benchmarks/fakeserver.py --record session.json            proxy to google and record
+#   python benchmarks/fakeserver.py --replay session.json            serve a recorded session
+#
+# and point CLEO at it with
+#
+#   python main.py 500 --auto --endpoint http://127.0.0.1:8900
+#   python main.py 500 --auto --endpoint http://127.0.0.1:8900 --endpoint-auth   when recording
+#
+# Synthetic mail is made from the fixtures in corpus.json. Errors are 429s and 503s, the
+# responses CLEO retries. Recording forwards every request to the real endpoint with the
+# caller's own credentials, so CLEO has to send them with --endpoint-auth; requests without
+# any are turned away rather than recorded as google's 401. Answers are stored in order per
+# method and path, replay hands them back in the same order and repeats the last one once
+# they run out
+
+import os.path
+import sys
+import json
+import base64
+import random
+import re
+import threading
+import urllib.request
+import urllib.error
+from time import sleep, time as time_now
+from datetime import datetime, timezone
+from email.parser import BytesParser
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+CORPUS_FILE = os.path.join(HERE, "corpus.json")
+FAKE_PORT = 8900
+
+# where recorded requests really go, by path prefix
+UPSTREAMS = [
+    ('/batch/calendar/', 'https://www.googleapis.com'),
+    ('/calendar/', 'https://www.googleapis.com'),
+    ('/batch', 'https://gmail.googleapis.com'),
+    ('/gmail/', 'https://gmail.googleapis.com'),
+    ('/v1beta/', 'https://generativelanguage.googleapis.com')
+]
+
+# headers worth passing on when recording
+FORWARD_HEADERS = ['authorization', 'content-type', 'x-goog-api-key', 'x-goog-api-client', 'user-agent']
+
+LOCATION = re.compile(r'\b(?:venue|location|where):?\s+([^\n.]+)', re.IGNORECASE)
+
+class Mailbox:
+    # synthetic gmail inbox, newest message first, with a history of what arrived when
+
+    def __init__(self, count, corpus = CORPUS_FILE):
+        with open(corpus, 'r') as f:
+            self.templates = json.load(f)
+
+        self.lock = threading.Lock()
+        self.messages = dict()
+        self.order = []
+        self.unread = set()
+        self.history = []
+        self.historyId = 1000
+
+        self.deliver(count)
+
+    def deliver(self, count):
+        with self.lock:
+            for _ in range(count):
+                self.historyId += 1
+                message_id = f"{self.historyId:016x}"
+                template = self.templates[len(self.messages) % len(self.templates)]
+
+                self.messages[message_id] = self.message(message_id, template)
+                self.order.insert(0, message_id)
+                self.unread.add(message_id)
+                self.history.append((self.historyId, message_id))
+
+    @staticmethod
+    def message(message_id, template):
+        data = base64.urlsafe_b64encode(template['body'].encode()).decode().rstrip('=')
+
+        return {
+            'id': message_id,
+            'threadId': message_id,
+            'labelIds': ['INBOX', 'UNREAD'],
+            'payload': {
+                'mimeType': template['mimeType'],
+                'headers': [
+                    {'name': 'From', 'value': template['from']},
+                    {'name': 'Subject', 'value': template['subject']},
+                    {'name': 'Date', 'value': template['date']}
+                ],
+                'body': {'size': len(template['body']), 'data': data}
+            }
+        }
+
+    def list(self, query):
+        maxResults = int(query.get('maxResults', ['100'])[0])
+        start = int(query.get('pageToken', ['0'])[0])
+        unread = 'is:unread' in query.get('q', [''])[0]
+
+        with self.lock:
+            ids = [message_id for message_id in self.order if not unread or message_id in self.unread]
+
+        page = ids[start:start + maxResults]
+        result = {'messages': [{'id': message_id, 'threadId': message_id} for message_id in page], 'resultSizeEstimate': len(ids)}
+
+        if start + maxResults < len(ids):
+            result['nextPageToken'] = str(start + maxResults)
+
+        return result
+
+    def get(self, message_id):
+        with self.lock:
+            return self.messages.get(message_id)
+
+    def modify(self, body):
+        with self.lock:
+            if 'UNREAD' in body.get('removeLabelIds', []):
+                self.unread.difference_update(body.get('ids', []))
+
+    def changes(self, query):
+        start = int(query['startHistoryId'][0])
+
+        with self.lock:
+            if self.history and start < self.history[0][0] - 1:
+                return None
+
+            added = [{'id': str(historyId), 'messagesAdded': [{'message': {'id': message_id}}]} for historyId, message_id in self.history if historyId > start]
+
+            return {'history': added, 'historyId': str(self.historyId)}
+
+class Calendar:
+    # primary calendar, events keyed by id
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = dict()
+
+    @staticmethod
+    def bounds(event):
+        def parse(value):
+            value = value.get('dateTime') or value.get('date')
+            moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            return moment if moment.tzinfo else moment.replace(tzinfo = timezone.utc)
+
+        return parse(event['start']), parse(event['end'])
+
+    def list(self, query):
+        timeMin = datetime.fromisoformat(query['timeMin'][0].replace('Z', '+00:00'))
+        timeMax = datetime.fromisoformat(query['timeMax'][0].replace('Z', '+00:00'))
+
+        with self.lock:
+            events = list(self.events.values())
+
+        items = [event for event in events if self.bounds(event)[0] < timeMax and self.bounds(event)[1] > timeMin]
+        items.sort(key = lambda event: self.bounds(event)[0])
+
+        return {'items': items}
+
+    def insert(self, event):
+        with self.lock:
+            event_id = event.get('id') or f"{random.getrandbits(128):032x}"
+
+            if event_id in self.events:
+                return 409, {'error': {'code': 409, 'message': 'The requested identifier already exists.'}}
+
+            event = dict(event, id = event_id, status = 'confirmed', htmlLink = f"http://fake.calendar/event?eid={event_id}")
+            self.events[event_id] = event
+
+        return 200, event
+
+    def delete(self, event_id):
+        with self.lock:
+            if self.events.pop(event_id, None) is None:
+                return 410, {'error': {'code': 410, 'message': 'Resource has been deleted'}}
+
+        return 204, None
+
+def answerEmail(text):
+    # title from the first line that reads like a sentence (skipping greetings), location from the venue line
+    lines = [line.strip() for line in text.strip().splitlines() if len(line.split()) > 3]
+    title = ' '.join((lines[0] if lines else 'Event').split()[:8])
+    location = LOCATION.search(text)
+    return title, location.group(1).strip() if location else ''
+
+def geminiAnswer(prompt):
+
+    # what CLEO's two prompts expect back: a json object for the batched one, one line otherwise
+
+    emails = re.findall(r'<email id="([^"]+)">\n(.*?)\n</email>', prompt, re.DOTALL)
+
+    if emails:
+        return json.dumps({mail_id: dict(zip(('title', 'location'), answerEmail(body))) for mail_id, body in emails})
+
+    body = prompt.split('takes place.', 1)[-1]
+    return '|'.join(answerEmail(body))
+
+class FakeGoogle:
+    # routes one request, returns (status, body) with body as a dict, or None for no content
+
+    def __init__(self, mailbox, calendar):
+        self.mailbox = mailbox
+        self.calendar = calendar
+
+    def handle(self, method, path, query, body):
+
+        parts = [part for part in path.split('/') if part]
+
+        if parts[:4] == ['gmail', 'v1', 'users', 'me']:
+            return self.gmail(method, parts[4:], query, body)
+
+        if parts[:4] == ['calendar', 'v3', 'calendars', 'primary'] and parts[4:5] == ['events']:
+            return self.events(method, parts[5:], query, body)
+
+        if parts[:1] == ['v1beta'] and path.endswith((':generateContent', ':streamGenerateContent')):
+            prompt = ' '.join(part.get('text', '') for content in body.get('contents', []) for part in content.get('parts', []))
+            return 200, {'candidates': [{'content': {'role': 'model', 'parts': [{'text': geminiAnswer(prompt)}]}, 'finishReason': 'STOP'}]}
+
+        return 404, {'error': {'code': 404, 'message': f'{method} {path} is not faked'}}
+
+    def gmail(self, method, parts, query, body):
+
+        if parts == ['messages'] and method == 'GET':
+            return 200, self.mailbox.list(query)
+
+        if parts == ['messages', 'batchModify'] and method == 'POST':
+            self.mailbox.modify(body)
+            return 204, None
+
+        if parts[:1] == ['messages'] and len(parts) == 2 and method == 'GET':
+            message = self.mailbox.get(parts[1])
+            return (200, message) if message else (404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}})
+
+        if parts == ['profile']:
+            return 200, {'emailAddress': 'fake@example.com', 'historyId': str(self.mailbox.historyId)}
+
+        if parts == ['history']:
+            changes = self.mailbox.changes(query)
+            return (200, changes) if changes else (404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}})
+
+        if parts == ['watch'] and method == 'POST':
+            return 200, {'historyId': str(self.mailbox.historyId), 'expiration': str(int((time_now() + 7 * 86400) * 1000))}
+
+        return 404, {'error': {'code': 404, 'message': 'Not found'}}
+
+    def events(self, method, parts, query, body):
+
+        if not parts and method == 'GET':
+            return 200, self.calendar.list(query)
+
+        if not parts and method == 'POST':
+            return self.calendar.insert(body)
+
+        if len(parts) == 1 and method == 'DELETE':
+            return self.calendar.delete(parts[0])
+
+        return 404, {'error': {'code': 404, 'message': 'Not found'}}
+
+class Cassette:
+    # responses keyed by method and path, in the order they were recorded
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.tapes = dict()
+        self.played = dict()
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.tapes = json.load(f)
+
+    def record(self, key, status, headers, body):
+        with self.lock:
+            self.tapes.setdefault(key, []).append({'status': status, 'headers': headers, 'body': body})
+
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.tapes, f, indent = 1)
+
+            os.replace(self.path + '.tmp', self.path)
+
+    def play(self, key):
+        with self.lock:
+            tape = self.tapes.get(key)
+
+            if not tape:
+                return None
+
+            i = self.played.get(key, 0)
+            self.played[key] = i + 1
+
+            return tape[min(i, len(tape) - 1)]
+
+def upstream(path):
+    for prefix, host in UPSTREAMS:
+        if path.startswith(prefix):
+            return host
+    return None
+
+class FakeHandler(BaseHTTPRequestHandler):
+    # self.server carries fake, latency, errorRate, cassette and mode
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.serve('GET')
+
+    def do_POST(self):
+        self.serve('POST')
+
+    def do_DELETE(self):
+        self.serve('DELETE')
+
+    def do_PATCH(self):
+        self.serve('PATCH')
+
+    def serve(self, method):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        url = urlparse(self.path)
+        server = self.server
+
+        if server.latency:
+            sleep(random.expovariate(1 / server.latency))
+
+        if server.errorRate and random.random() < server.errorRate:
+            status = random.choice((429, 503))
+            return self.reply(status, {'Content-Type': 'application/json'}, json.dumps({'error': {'code': status, 'message': 'Injected error'}}).encode())
+
+        if server.mode == 'record':
+            return self.record(method, body)
+
+        if server.mode == 'replay':
+            tape = server.cassette.play(f"{method} {url.path}")
+
+            if tape is None:
+                return self.reply(404, {'Content-Type': 'application/json'}, b'{"error": {"code": 404, "message": "Not in cassette"}}')
+
+            return self.reply(tape['status'], tape['headers'], tape['body'].encode())
+
+        if url.path.startswith('/batch'):
+            return self.batch(body)
+
+        status, answer = server.fake.handle(method, url.path, parse_qs(url.query), json.loads(body) if body else {})
+        self.answer(status, answer, stream = 'alt=sse' in url.query)
+
+    def answer(self, status, answer, stream = False):
+        if answer is None:
+            return self.reply(status, {}, b'')
+
+        if stream:
+            return self.reply(status, {'Content-Type': 'text/event-stream'}, f"data: {json.dumps(answer)}\r\n\r\n".encode())
+
+        self.reply(status, {'Content-Type': 'application/json'}, json.dumps(answer).encode())
+
+    def batch(self, body):
+
+        # multipart/mixed of application/http requests, answered in kind
+
+        message = BytesParser().parsebytes(b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+        boundary = f"batch_{random.getrandbits(64):016x}"
+        out = []
+
+        for part in message.get_payload():
+            request = part.get_payload()
+            head, _, content = request.partition('\n\n')
+            method, target, _ = head.splitlines()[0].split(' ', 2)
+            url = urlparse(target)
+
+            status, answer = self.server.fake.handle(method, url.path, parse_qs(url.query), json.loads(content) if content.strip() else {})
+            text = json.dumps(answer) if answer is not None else ''
+
+            out.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{' '.join(part['Content-ID'].split())[1:-1]}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status < 300 else 'Error'}\r\nContent-Type: application/json\r\n\r\n{text}\r\n"
+            )
+
+        out.append(f"--{boundary}--\r\n")
+
+        self.reply(200, {'Content-Type': f'multipart/mixed; boundary={boundary}'}, ''.join(out).encode())
+
+    def record(self, method, body):
+        host = upstream(self.path)
+
+        if host is None:
+            return self.reply(404, {}, b'')
+
+        headers = {key: value for key, value in self.headers.items() if key.lower() in FORWARD_HEADERS}
+
+        # anonymous requests would only record google's 401s
+        if not {'authorization', 'x-goog-api-key'} & {key.lower() for key in headers}:
+            message = 'No credentials to pass on, run main.py with --endpoint-auth'
+            return self.reply(401, {'Content-Type': 'application/json'}, json.dumps({'error': {'code': 401, 'message': message}}).encode())
+        request = urllib.request.Request(host + self.path, data = body or None, headers = headers, method = method)
+
+        try:
+            with urllib.request.urlopen(request, timeout = 60) as response:
+                status, content, kept = response.status, response.read(), dict(response.headers)
+        except urllib.error.HTTPError as error:
+            status, content, kept = error.code, error.read(), dict(error.headers)
+
+        kept = {key: value for key, value in kept.items() if key.lower() == 'content-type'}
+
+        self.server.cassette.record(f"{method} {urlparse(self.path).path}", status, kept, content.decode('utf-8', errors = 'replace'))
+        self.reply(status, kept, content)
+
+    def reply(self, status, headers, content):
+        self.send_response(status)
+
+        for key, value in headers.items():
+            self.send_header(key, value)
+
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+def startFakeServer(port = FAKE_PORT, mails = 1000, latency = 0.0, errorRate = 0.0, cassette = None, mode = 'fake'):
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeHandler)
+    server.daemon_threads = True
+    server.fake = FakeGoogle(Mailbox(mails), Calendar())
+    server.latency = latency
+    server.errorRate = errorRate
+    server.cassette = Cassette(cassette) if cassette else None
+    server.mode = mode
+
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+
+    return server
+
+def argValue(flag, default = None):
+    # value following flag on the command line
+    if flag in sys.argv[:-1]:
+        return sys.argv[sys.argv.index(flag) + 1]
+    return default
+
+def main():
+
+    cassette = argValue('--record') or argValue('--replay')
+    mode = 'record' if argValue('--record') else 'replay' if argValue('--replay') else 'fake'
+    arrivalRate = float(argValue('--arrival-rate', 0))
+
+    server = startFakeServer(
+        int(argValue('--port', FAKE_PORT)),
+        int(argValue('--mails', 1000)),
+        float(argValue('--latency', 0)),
+        float(argValue('--error-rate', 0)),
+        cassette,
+        mode
+    )
+
+    print(f"[~] Fake google ({mode}) on http://127.0.0.1:{server.server_address[1]}, {len(server.fake.mailbox.messages)} mails")
+
+    try:
+        while True:
+            if arrivalRate:
+                sleep(1 / arrivalRate)
+                server.fake.mailbox.deliver(1)
+            else:
+                sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -1,65 +1,418 @@
+from time import perf_counter
+IMPORT_STARTED = perf_counter()
+
 import os.path
 import base64
-from time import sleep
-from bs4 import BeautifulSoup
-import dateparser
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+import json
+import uuid
+import bisect
+import heapq
+import hashlib
+import sqlite3
+import queue
+import random
+import threading
+import signal
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from html.parser import HTMLParser
+from time import sleep, monotonic, time as time_now
+from google.auth.credentials import AnonymousCredentials
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
 from googleapiclient.errors import HttpError
 import re
-from datetime import datetime, time
+from datetime import datetime, date, time, timedelta, timezone
+from functools import lru_cache
+from contextlib import contextmanager
+from dataclasses import dataclass, fields
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import sys
 from termcolor import colored
 import os
-from google import genai
-from google.genai import types
-from tqdm import tqdm
+import importlib
+
+# dateparser, genai, the api client builder, the oauth flow and tqdm take most of the startup
+# time and many runs never need them (a quiet cycle, --help like runs, importing for tests),
+# so they are imported by the stages that use them. --startup-profile shows what each costs
+LAZY_IMPORTS = [
+    'dateparser',
+    'google.genai',
+    'googleapiclient.discovery',
+    'google.auth.transport.requests',
+    'google_auth_oauthlib.flow',
+    'google.oauth2.credentials',
+    'tqdm'
+]
 
-print('''
+# languages dateparser loads and tries, detecting the language of every string is its slowest step
+DATEPARSER_LANGUAGES = ['en']
+
+BANNER = '''
     ░█████╗░██╗░░░░░███████╗░█████╗░
     ██╔══██╗██║░░░░░██╔════╝██╔══██╗
     ██║░░╚═╝██║░░░░░█████╗░░██║░░██║
     ██║░░██╗██║░░░░░██╔══╝░░██║░░██║
     ╚█████╔╝███████╗███████╗╚█████╔╝
     ░╚════╝░╚══════╝╚══════╝░╚════╝░
-''')
+'''
 
 SCOPES = [
     "https://www.googleapis.com/auth/gmail.modify",
     "https://www.googleapis.com/auth/calendar"
 ]
 
+# per thread cache of built api clients, see getService
+SERVICES = threading.local()
+HTTP_TIMEOUT = 60
+
+# Gmail, Calendar and Gemini requests go to this server instead of google when set, with
+# anonymous credentials. For load testing against benchmarks/fakeserver.py, see --endpoint.
+# With API_ENDPOINT_AUTH the real token and gemini key are sent along, which a recording
+# proxy (fakeserver.py --record) needs to pass the requests on to google
+API_ENDPOINT = os.environ.get("CLEO_ENDPOINT")
+API_ENDPOINT_AUTH = False
+GOOGLE_HOSTS = ('https://gmail.googleapis.com', 'https://www.googleapis.com')
+
+# Gmail recommends batches of at most 50 calls
+GMAIL_BATCH_SIZE = 50
+BATCH_MODIFY_LIMIT = 1000
+
+# partial response, only what parseMessage reads
+MESSAGE_FIELDS = 'id,payload(mimeType,headers,body,parts)'
+
+# sender lists and keywords for the relevance filter, RelevanceFilter.DEFAULTS when missing
+FILTER_FILE = "filter.json"
+
+# mails the relevance filter turns down are not parsed at all, --no-filter parses everything
+RELEVANCE_FILTER = True
+
+# only this much of a mail body is decoded, and html is parsed this many characters at a time
+BODY_MAX_BYTES = 256 * 1024
+HTML_CHUNK_SIZE = 16 * 1024
+
+# last gmail historyId seen by syncMail
+HISTORY_FILE = "history.json"
+
+# threads per stage and the size of the queues between stages for runPipeline
+PIPELINE_WORKERS = {'extract': 2, 'enrich': 4}
+PIPELINE_QUEUE_SIZE = 32
+
+GEMINI_MODEL = "gemini-2.0-flash-lite"
+GEMINI_KEY_FILE = "gemini-api.key"
+
+# requests per minute allowed for GEMINI_MODEL and how many may be in flight at once
+GEMINI_RPM = 30
+GEMINI_MAX_IN_FLIGHT = 4
+
+# mails per batched title/location request and the prompt tokens they may use
+GEMINI_BATCH_SIZE = 8
+GEMINI_BATCH_TOKENS = 6000
+
+# bump whenever the title/location prompts change so old answers are not reused
+PROMPT_VERSION = 1
+
+# on disk cache of title/location answers, see TitleCache
+TITLE_CACHE_FILE = "title-cache.db"
+TITLE_CACHE_TTL = 30 * 24 * 60 * 60
+TITLE_CACHE_SIZE = 10000
+
+# retries for 429/5xx responses, waiting GEMINI_BACKOFF * 2^attempt seconds plus jitter
+GEMINI_RETRIES = 4
+GEMINI_BACKOFF = 2
+
+# calendar requests per http batch, and retries for the ones that fail
+CALENDAR_BATCH_SIZE = 50
+CALENDAR_RETRIES = 3
+CALENDAR_BACKOFF = 1
+
+# bounds for the adaptive polling interval of --auto mode, and the +-fraction of jitter
+DAEMON_MIN_INTERVAL = 60
+DAEMON_MAX_INTERVAL = 3600
+DAEMON_JITTER = 0.1
 
-def authenticate():
+# address of the local Gmail push notification receiver, and how long before
+# the gmail watch expires it gets renewed. Only loopback is served unless a
+# push token is set, anyone who can reach the port could trigger syncs otherwise
+PUSH_HOST = "127.0.0.1"
+PUSH_PORT = 8080
+WATCH_RENEW_BEFORE = 24 * 60 * 60
+
+# what happened to every message CLEO has fetched, see Ledger
+LEDGER_FILE = "ledger.db"
+LEDGER_MAX_ATTEMPTS = 3
+
+# finished messages are forgotten after this long. One fetched again later is harmless,
+# its events have deterministic ids so inserting them again only gets a 409
+LEDGER_MAX_AGE = 180 * 24 * 60 * 60
+
+# process pool used by extractDateTimeParallel (--workers N) and the mails sent to a worker at once
+EXTRACT_WORKERS = os.cpu_count() or 1
+EXTRACT_CHUNK_SIZE = 50
+
+# mail text scanned for dates and sent to gemini once quotes and footers are cut, see segmentText
+SEGMENT_MAX_TOKENS = 512
+
+# fields extractDateTime sets on a mail
+DATETIME_FIELDS = ['startdate', 'enddate', 'starttime', 'endtime', 'daily', 'all_dates']
+
+# resumable page token of --backfill, and messages per listed page (gmail allows 500)
+BACKFILL_FILE = "backfill.json"
+BACKFILL_PAGE_SIZE = 500
+
+# one json line of per stage timings and api counts is appended here after every cycle,
+# and the same metrics are served as prometheus text on METRICS_HOST:METRICS_PORT in daemon mode
+METRICS_FILE = "metrics.jsonl"
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+
+# --accounts serves every mailbox in ACCOUNTS_FILE from one process, each account keeps its
+# token, history checkpoint and ledger in ACCOUNTS_DIR/<name>/. Cycles of up to ACCOUNT_WORKERS
+# accounts run at once, and tokens expiring within TOKEN_REFRESH_BEFORE seconds are refreshed
+# in the background and written back
+ACCOUNTS_FILE = "accounts.json"
+ACCOUNTS_DIR = "accounts"
+ACCOUNT_WORKERS = 4
+TOKEN_REFRESH_BEFORE = 5 * 60
+TOKEN_CHECK_INTERVAL = 60
+
+# account the current thread is working for, see accountPath
+ACCOUNT = threading.local()
+
+# end of stream marker for pipeline queues
+STOP = object()
+
+
+def authenticate(token = "token.json", secrets = "credentials.json"):
+
+    from google.oauth2.credentials import Credentials
 
     creds = None
 
     # if token.json exists check if creds are still valid
-    if os.path.exists("token.json"):
-        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+    if os.path.exists(token):
+        creds = Credentials.from_authorized_user_file(token, SCOPES)
     
     # if not valid refresh
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
+            from google.auth.transport.requests import Request
             creds.refresh(Request())
         
         else:
+            from google_auth_oauthlib.flow import InstalledAppFlow
 
             flow = InstalledAppFlow.from_client_secrets_file(
-                "credentials.json", SCOPES
+                secrets, SCOPES
             )
 
             creds = flow.run_local_server(port=0)
 
-            with open("token.json", "w") as token:
-                token.write(creds.to_json())
+        saveToken(creds, token)
         
     return creds
 
+def saveToken(creds, path = "token.json"):
+    # refreshed credentials are written back so the next start doesn't refresh again
+    with open(path + '.tmp', 'w') as f:
+        f.write(creds.to_json())
+
+    os.replace(path + '.tmp', path)
+
+def accountPath(path):
+    # state files of the account this thread is working for, or the plain path outside --accounts
+    directory = getattr(ACCOUNT, 'directory', None)
+    return os.path.join(directory, path) if directory else path
+
+def inAccount(fn):
+    # fn running for the account of the calling thread, for work handed to a thread pool
+    name, directory, metrics = (getattr(ACCOUNT, key, None) for key in ('name', 'directory', 'metrics'))
+
+    def run(*args):
+        ACCOUNT.name, ACCOUNT.directory, ACCOUNT.metrics = name, directory, metrics
+        try:
+            return fn(*args)
+        finally:
+            ACCOUNT.name = ACCOUNT.directory = ACCOUNT.metrics = None
+
+    return run
+
+def ask(prompt):
+    # input() whose wait is left out of the stage timers, see Metrics.timer
+    start = monotonic()
+    try:
+        return input(prompt)
+    finally:
+        Metrics.prompts.waited = getattr(Metrics.prompts, 'waited', 0.0) + monotonic() - start
+
+class Metrics:
+    # Counters and timings. Counters are keyed by name and labels, timings keep calls, seconds
+    # and items per stage so throughput and latency can be derived from them.
+    # cycle() returns what changed since the previous cycle, prometheus() the running totals.
+    # Each --accounts account has its own, which passes everything on to the process wide
+    # METRICS with an account label, so its cycles only see their own numbers
+
+    # seconds each thread spent at a prompt, see ask
+    prompts = threading.local()
+
+    def __init__(self, parent = None, **labels):
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.timings = dict()
+        self.previous = ({}, {})
+        self.parent = parent
+        self.labels = labels
+
+    def count(self, name, value = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+        if self.parent:
+            self.parent.count(name, value, **labels, **self.labels)
+
+    def observe(self, name, seconds, items = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            calls, total, count = self.timings.get(key, (0, 0.0, 0))
+            self.timings[key] = (calls + 1, total + seconds, count + items)
+
+        if self.parent:
+            self.parent.observe(name, seconds, items, **labels, **self.labels)
+
+    @contextmanager
+    def timer(self, stage, items = 1):
+        # time spent waiting for the user to answer a prompt is not the stage's
+        start = monotonic()
+        waited = getattr(self.prompts, 'waited', 0.0)
+        try:
+            yield
+        finally:
+            self.observe('stage', monotonic() - start - (getattr(self.prompts, 'waited', 0.0) - waited), items, stage = stage)
+
+    def cycle(self):
+
+        # {'stages': {stage: {calls, seconds, items}}, 'counters': {name: {labels: value}}} since the last call
+
+        with self.lock:
+            counters, timings = dict(self.counters), dict(self.timings)
+            before, self.previous = self.previous, (counters, timings)
+
+        summary = {'stages': {}, 'api': {}, 'counters': {}}
+
+        for (name, labels), (calls, seconds, items) in timings.items():
+            was = before[1].get((name, labels), (0, 0.0, 0))
+
+            if calls == was[0]:
+                continue
+
+            label = dict(labels).get('stage', dict(labels).get('api'))
+            target = summary['stages'] if name == 'stage' else summary['api']
+            target[label] = {'calls': calls - was[0], 'seconds': round(seconds - was[1], 4), 'items': items - was[2]}
+
+        for (name, labels), value in counters.items():
+            delta = value - before[0].get((name, labels), 0)
+
+            if delta:
+                key = ','.join(f"{k}={v}" for k, v in labels) or 'total'
+                summary['counters'].setdefault(name, {})[key] = delta
+
+        return summary
+
+    def prometheus(self):
+
+        # running totals in the prometheus text exposition format
+
+        with self.lock:
+            counters, timings = dict(self.counters), dict(self.timings)
+
+        def labelText(labels):
+            return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}' if labels else ''
+
+        lines = []
+
+        for metric in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE cleo_{metric}_total counter")
+            for (name, labels), value in sorted(counters.items()):
+                if name == metric:
+                    lines.append(f"cleo_{metric}_total{labelText(labels)} {value}")
+
+        for metric in sorted({name for name, _ in timings}):
+            lines.append(f"# TYPE cleo_{metric}_seconds summary")
+            for (name, labels), (calls, seconds, items) in sorted(timings.items()):
+                if name == metric:
+                    lines.append(f"cleo_{metric}_seconds_sum{labelText(labels)} {seconds}")
+                    lines.append(f"cleo_{metric}_seconds_count{labelText(labels)} {calls}")
+
+            lines.append(f"# TYPE cleo_{metric}_items_total counter")
+            for (name, labels), (calls, seconds, items) in sorted(timings.items()):
+                if name == metric:
+                    lines.append(f"cleo_{metric}_items_total{labelText(labels)} {items}")
+
+        return '\n'.join(lines) + '\n'
+
+METRICS = Metrics()
+
+def getMetrics():
+    # metrics of the account this thread is working for, or the process wide ones
+    return getattr(ACCOUNT, 'metrics', None) or METRICS
+
+class CountingHttp(AuthorizedHttp):
+    # AuthorizedHttp that counts and times every request it sends, a batch is one request
+
+    def __init__(self, credentials, http, api):
+        super().__init__(credentials, http = http)
+        self.api = api
+
+    def request(self, uri, method = 'GET', *args, **kwargs):
+        start = monotonic()
+
+        # batch uris don't follow the client's api_endpoint, so the host is swapped here for everything
+        if API_ENDPOINT and uri.startswith(GOOGLE_HOSTS):
+            uri = API_ENDPOINT.rstrip('/') + '/' + uri.split('/', 3)[3]
+
+        try:
+            response, content = super().request(uri, method, *args, **kwargs)
+        except Exception:
+            getMetrics().count('api_requests', api = self.api, status = 'error')
+            raise
+
+        getMetrics().observe('api', monotonic() - start, api = self.api)
+        getMetrics().count('api_requests', api = self.api, status = response.status)
+
+        return response, content
+
+def getService(name, version, creds):
+
+    # Google API clients are built once from the discovery documents bundled with
+    # googleapiclient and reused, so their connections stay alive between calls and cycles.
+    # httplib2 is not thread safe, so every thread gets its own client. New credentials
+    # (or refreshed ones) are swapped into the existing client instead of rebuilding it
+
+    services = getattr(SERVICES, 'services', None)
+
+    if services is None:
+        services = SERVICES.services = dict()
+
+    if (name, version) not in services:
+        from googleapiclient.discovery import build
+
+        http = CountingHttp(creds, httplib2.Http(timeout = HTTP_TIMEOUT), name)
+        services[(name, version)] = (http, build(name, version, http = http, static_discovery = True, cache_discovery = False))
+
+    http, service = services[(name, version)]
+
+    if http.credentials is not creds:
+        http.credentials = creds
+
+    return service
+
 def dtparse(str: str, context_time = None):
 
+    import dateparser
+
     settings = {
         'DATE_ORDER': 'DMY'
     }
@@ -67,794 +420,3188 @@ def dtparse(str: str, context_time = None):
     if context_time:
         settings['RELATIVE_BASE'] = context_time
 
-    return dateparser.parse(str, settings = settings)
+    return dateparser.parse(str, languages = DATEPARSER_LANGUAGES, settings = settings)
+
+class TextExtractor(HTMLParser):
+    # Streaming html to text: keeps the text nodes, drops style/script/head, starts a new line
+    # at block level tags, separates table cells and collapses runs of spaces. Inline tags add
+    # no space, so "<b>Sem</b>inar" stays one word. Stops collecting after limit characters
+
+    SKIP = {'style', 'script', 'head', 'noscript', 'template'}
+    BLOCK = {'br', 'p', 'div', 'tr', 'li', 'ul', 'ol', 'table', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'blockquote', 'section', 'article', 'header', 'footer'}
+    CELL = {'td', 'th', 'dt', 'dd'}
+
+    def __init__(self, limit):
+        super().__init__(convert_charrefs = True)
+        self.limit = limit
+        self.size = 0
+        self.skipping = 0
+        self.lines = [[]]
+
+    def boundary(self, tag):
+        if tag in self.BLOCK:
+            self.lines.append([])
+        elif tag in self.CELL:
+            self.lines[-1].append(' ')
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self.skipping += 1
+        else:
+            self.boundary(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP:
+            self.skipping = max(0, self.skipping - 1)
+        else:
+            self.boundary(tag)
 
-def getEmailBody(parts, type):
+    def handle_data(self, data):
+        if self.skipping or self.full():
+            return
 
-    # check for plain text
-    for part in parts:
-        if part.get('mimeType') == 'text/plain':
-            data = part[type].get("data")
+        for i, line in enumerate(data.split('\n')):
+            if i:
+                self.lines.append([])
+
+            # kept as is, words split over inline tags are joined back up in text()
+            self.lines[-1].append(line)
+            self.size += len(line)
+
+    def full(self):
+        return self.size >= self.limit
+
+    def text(self):
+        lines = (' '.join(''.join(fragments).split()) for fragments in self.lines)
+        return '\n'.join(line for line in lines if line)
+
+def htmlToText(html, limit = BODY_MAX_BYTES):
+
+    parser = TextExtractor(limit)
+
+    # feed in chunks so we can stop early on huge documents
+    for i in range(0, len(html), HTML_CHUNK_SIZE):
+        parser.feed(html[i:i + HTML_CHUNK_SIZE])
+
+        if parser.full():
+            break
+
+    parser.close()
+
+    return parser.text()
+
+def findPart(part, mimeType):
+
+    # depth first search of the mime tree for the first inline part of mimeType, so
+    # text/plain nested in multipart/alternative inside multipart/mixed is found too
+
+    if part.get('mimeType') == mimeType and part.get('body', {}).get('data') and not part.get('filename'):
+        return part
+
+    for child in part.get('parts', []):
+        found = findPart(child, mimeType)
+
+        if found:
+            return found
+
+    return None
+
+def decodePart(part, maxBytes = BODY_MAX_BYTES):
+
+    # text of a part in its declared charset, only the first maxBytes are decoded
+
+    data = part['body']['data']
+
+    # every 4 base64 characters are 3 bytes, cutting on a multiple of 4 keeps the prefix valid
+    data = data[:-(-maxBytes // 3) * 4]
+    byte_code = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))[:maxBytes]
+
+    charset = 'utf-8'
+
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-type':
+            match = re.search(r'charset="?([\w.:-]+)', header['value'], re.IGNORECASE)
+            if match:
+                charset = match.group(1)
+
+    try:
+        return byte_code.decode(charset, errors = 'replace')
+    except LookupError:
+        return byte_code.decode('utf-8', errors = 'replace')
+
+def getEmailBody(payload, maxBytes = BODY_MAX_BYTES):
+
+    # prefer plain text anywhere in the message, fall back to stripped html
+
+    part = findPart(payload, 'text/plain')
+
+    if part:
+        return decodePart(part, maxBytes)
+
+    part = findPart(payload, 'text/html')
+
+    if part:
+        return htmlToText(decodePart(part, maxBytes), maxBytes)
 
-            if data:
-                byte_code = base64.urlsafe_b64decode(data)
-                text = byte_code.decode("utf-8")
-                return text
-    
-    # parse html using beautiful soup 4
-    for part in parts:
-        if part.get('mimeType') == 'text/html':
-            data = part['text'].get('data')
-            if data:
-                byte_code = base64.urlsafe_b64decode(data)
-                html = byte_code.decode("utf-8")
-                soup = BeautifulSoup(html, 'html.parser')
-                return soup.get_text()
-    
     # nothing to do
     return ''
 
-def getMail(creds, maxResults):
+@dataclass(slots = True)
+class Mail:
+    # A fetched message and what was extracted from it. Slotted records with fixed fields
+    # instead of dicts keep a large backlog small, and the body, by far the biggest part,
+    # is let go with release() as soon as nothing needs the text any more
 
-    mails = []
+    id: str
+    sender: str = ''
+    subject: str = ''
+    when: datetime = None
+    body: str = ''
 
-    try:
-        service = build("gmail", "v1", credentials=creds)
-        try:
-            results = service.users().messages().list(userId = "me", labelIds = ['INBOX'], maxResults = maxResults, q='is:unread newer_than:2d').execute()
-        except Exception as e:
-            print(f"[!] Error occurred while fetching mail: {e}")
-            return []
+    # the part of body extraction and enrichment look at, set by extractDateTime, see segmentText
+    excerpt: str = None
 
-        messages = results.get('messages', [])
+    # set by extractDateTime, see DATETIME_FIELDS
+    startdate: date = None
+    enddate: date = None
+    starttime: time = None
+    endtime: time = None
+    daily: bool = None
+    all_dates: list = None
 
-        for message in messages:
+    # set by extractTitleLocation
+    title: str = None
+    location: str = None
 
-            mail = dict()
+    def release(self):
+        self.body = None
 
-            msg = service.users().messages().get(userId = "me", id = message['id']).execute()
-            headers = msg['payload']['headers']
+def parseMessage(msg):
 
-            # extract from, subject, datetime from headers
-            for values in headers:
-                name = values['name']
+    mail = Mail(msg['id'])
 
-                if name == 'From':
-                    mail['from'] = values['value']
+    headers = msg['payload']['headers']
 
-                elif name == 'Subject':
-                    mail['subject'] = values['value']
+    # extract from, subject, datetime from headers
+    for values in headers:
+        name = values['name']
 
-                elif name == "Date":
-                    date_format = "%a, %d %b %Y %H:%M:%S %z"
-                    mail['when'] = datetime.strptime(values['value'], date_format)
-                
-            if 'parts' in msg['payload']:
+        if name == 'From':
+            mail.sender = values['value']
 
-                parts = msg['payload']['parts']
+        elif name == 'Subject':
+            mail.subject = values['value']
 
-                body = getEmailBody(parts, "body").lower()
+        elif name == "Date":
+            date_format = "%a, %d %b %Y %H:%M:%S %z"
+            mail.when = datetime.strptime(values['value'], date_format)
 
-                # Doing it this way so I dont have to deal with escape characters
-                mail['body'] = body
+    payload = msg['payload']
 
-                mails.append(mail)
-                
-                # Mark email as read by removing the UNREAD label
-                service.users().messages().modify(
-                    userId="me",
-                    id=message['id'],
-                    body={'removeLabelIds': ['UNREAD']}
-                ).execute()
+    if 'parts' not in payload and not payload.get('body', {}).get('data'):
+        return None
 
-        return mails   
+    body = getEmailBody(payload).lower()
 
-    
-    except HttpError as error:
-        print(f"An error occurred: {error}")
+    # Doing it this way so I dont have to deal with escape characters
+    mail.body = body
 
-def parseDateRange(text: str, context_time):
+    return mail
 
-    # Parses sequential multidates such as 14th - 16th august 2025 and 8th to 30th August
+def getMessages(service, ids, batchSize = GMAIL_BATCH_SIZE):
 
-    regexes = [
-        # Pattern for 14th - 16th August 2023 or 14-16 August 2023
-        r'\b(\d{1,2})(?:th|st|nd|rd)?\s*(?:to|-)\s*(\d{1,2})(?:th|st|nd|rd)?(?:\s+of)?\s+((?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|jun(?:e)?|jul(?:y)?|aug(?:ust)?|sep(?:tember)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)(?:\s+\d{2,4})?)\b',
-        
-        # Pattern for August 14-16, 2023
-        r'\b((?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|jun(?:e)?|jul(?:y)?|aug(?:ust)?|sep(?:tember)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?))\s+(\d{1,2})(?:th|st|nd|rd)?\s*(?:to|-)\s*(\d{1,2})(?:th|st|nd|rd)?(?:,?\s+(\d{2,4})?)?\b',
-        
-        # Pattern for from 14th August to 16th August 2023
-        r'\bfrom\s+(\d{1,2})(?:th|st|nd|rd)?\s+((?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|jun(?:e)?|jul(?:y)?|aug(?:ust)?|sep(?:tember)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?))\s+to\s+(\d{1,2})(?:th|st|nd|rd)?\s+((?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|jun(?:e)?|jul(?:y)?|aug(?:ust)?|sep(?:tember)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)(?:\s+\d{2,4})?)\b'
-    ]   
+    # fetch messages batchSize at a time with one http request per batch
+    # instead of one request per message, asking only for the fields we use.
+    # returns the messages and {id: exception} for the ones whose part of a batch failed
 
-    for i, regex in enumerate(regexes):
+    messages = dict()
+    failed = dict()
 
-        match = re.search(regex, text)
+    def callback(request_id, response, exception):
+        if exception is not None:
+            print(f"[!] Error occurred while fetching message {request_id}: {exception}")
+            failed[request_id] = exception
+            return
+        messages[request_id] = response
 
-        if match:
-            groups = match.groups()
+    for i in range(0, len(ids), batchSize):
 
-            if i == 0:
-                day1, day2, month_year = groups
-                date1_str = f"{day1} {month_year}"
-                date2_str = f"{day2} {month_year}"
+        batch = service.new_batch_http_request(callback = callback)
 
-            elif i == 1:
-                month, day1, day2, year = groups
-                year = year or ''
-                date1_str = f"{day1} {month} {year}"
-                date2_str = f"{day2} {month} {year}"
-            
-            elif i == 2:
-                day1, month1, day2, month2_year = groups
-                date1_str = f"{day1} {month1}"
-                date2_str = f"{day2} {month2_year}"
+        for message_id in ids[i:i + batchSize]:
+            batch.add(
+                service.users().messages().get(userId = "me", id = message_id, fields = MESSAGE_FIELDS),
+                request_id = message_id
+            )
 
-            date1 = datetime.date(dtparse(date1_str, context_time))
-            date2 = datetime.date(dtparse(date2_str, context_time))
+        batch.execute()
+
+    # keep the order messages().list returned them in
+    return [messages[message_id] for message_id in ids if message_id in messages], failed
+
+def markRead(service, ids):
+
+    # Mark emails as read by removing the UNREAD label, batchModify takes up to 1000 ids per call
+    for i in range(0, len(ids), BATCH_MODIFY_LIMIT):
+        service.users().messages().batchModify(
+            userId = "me",
+            body = {'ids': ids[i:i + BATCH_MODIFY_LIMIT], 'removeLabelIds': ['UNREAD']}
+        ).execute()
+
+class Ledger:
+    # Durable record of every message CLEO has seen and how far it got:
+    #   fetched -> extracted -> inserting -> done, or skipped when there is nothing to add,
+    #   and pending for a message whose fetch failed.
+    # Finished ids are also kept in memory so they are dropped before any api call or parsing,
+    # and messages that never reached a final state are picked up again after a crash.
+    # Mails the relevance filter turned down are filtered, which is neither: they aren't resumed,
+    # but a later listing (a backfill, say, or a run with --no-filter) takes them up again.
+    # A message that fails LEDGER_MAX_ATTEMPTS times is given up on, and finished or filtered
+    # messages older than maxAge are pruned whenever the ledger is opened
+
+    FINAL = ('done', 'skipped', 'failed')
+    SETTLED = FINAL + ('filtered',)
+
+    def __init__(self, path = LEDGER_FILE, maxAttempts = LEDGER_MAX_ATTEMPTS, maxAge = LEDGER_MAX_AGE):
+        self.maxAttempts = maxAttempts
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages (id TEXT PRIMARY KEY, state TEXT, attempts INTEGER, result TEXT, events TEXT, updated REAL)")
+        self.db.execute("DELETE FROM messages WHERE state IN (?, ?, ?, ?) AND updated < ?", (*self.SETTLED, time_now() - maxAge))
+        self.db.commit()
+
+        self.final = {row[0] for row in self.db.execute("SELECT id FROM messages WHERE state IN (?, ?, ?)", self.FINAL)}
+
+    def finished(self, message_id):
+        return message_id in self.final
+
+    def unfinished(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT id FROM messages WHERE state NOT IN (?, ?, ?, ?) ORDER BY updated", self.SETTLED)]
+
+    def record(self, message_id, state, result = None, events = None):
+        with self.lock:
+            row = self.db.execute("SELECT attempts, result, events FROM messages WHERE id = ?", (message_id,)).fetchone()
+            attempts, old_result, old_events = row or (0, None, None)
+
+            # a fetch that failed is an attempt too
+            if state in ('fetched', 'pending'):
+                attempts += 1
+
+                if attempts > self.maxAttempts:
+                    state = 'failed'
+
+            # turning a mail down isn't a failed attempt at it
+            if state == 'filtered':
+                attempts = 0
+
+            self.db.execute(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+                (message_id, state, attempts,
+                 json.dumps(result, default = str) if result is not None else old_result,
+                 json.dumps(events) if events is not None else old_events,
+                 time_now())
+            )
+            self.db.commit()
 
-            return [date1, date2]
-    
-    return None
+            if state in self.FINAL:
+                self.final.add(message_id)
 
-def parseConnectedDates(text: str, context_time):
-    """Parse date patterns like "8th & 9th Jan" or "8th and 9th January"."""
-    
-    # Patterns for dates connected with &, and, or commas
-    connected_dates_regex = [
-        # Pattern for "8th & 9th Jan" or "8th and 9th January"
-        r'\b(\d{1,2})(?:th|st|nd|rd)?\s*(?:&|and)\s*(\d{1,2})(?:th|st|nd|rd)?\s+((?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|jun(?:e)?|jul(?:y)?|aug(?:ust)?|sep(?:tember)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)(?:\s+\d{2,4})?)\b',
-        
-        # Pattern for "Jan 8th & 9th" or "January 8th and 9th"
-        r'\b((?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|jun(?:e)?|jul(?:y)?|aug(?:ust)?|sep(?:tember)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?))\s+(\d{1,2})(?:th|st|nd|rd)?\s*(?:&|and)\s*(\d{1,2})(?:th|st|nd|rd)?(?:,?\s+(\d{2,4})?)?\b',
-        
-        # Pattern for comma-separated dates like "8th, 9th, and 10th Jan"
-        r'\b(\d{1,2})(?:th|st|nd|rd)?(?:\s*,\s*(\d{1,2})(?:th|st|nd|rd)?)+(?:\s*(?:&|and)\s*(\d{1,2})(?:th|st|nd|rd)?)?\s+((?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|jun(?:e)?|jul(?:y)?|aug(?:ust)?|sep(?:tember)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)(?:\s+\d{2,4})?)\b'
-    ]
-    
-    results = []
-    
-    for i, regex in enumerate(connected_dates_regex):
-        matches = re.finditer(regex, text, re.IGNORECASE)
-        
-        for match in matches:
-            groups = match.groups()
-            
-            if i == 0:  # 8th & 9th Jan
-                day1, day2, month_year = groups
-                date1_str = f"{day1} {month_year}"
-                date2_str = f"{day2} {month_year}"
-                
-                date1 = datetime.date(dtparse(date1_str, context_time))
-                date2 = datetime.date(dtparse(date2_str, context_time))
-                
-                if date1 and date2:
-                    results.extend([date1, date2])
-                    
-            elif i == 1:  # Jan 8th & 9th
-                month, day1, day2, year = groups
-                year = year or ''
-                date1_str = f"{day1} {month} {year}"
-                date2_str = f"{day2} {month} {year}"
-                
-                date1 = datetime.date(dtparse(date1_str, context_time))
-                date2 = datetime.date(dtparse(date2_str, context_time))
-                
-                if date1 and date2:
-                    results.extend([date1, date2])
-                    
-            elif i == 2:  # 8th, 9th, and 10th Jan
-                # This is more complex as we have variable number of days
-                days = [g for g in groups[:-1] if g is not None]
-                month_year = groups[-1]
-                
-                for day in days:
-                    date_str = f"{day} {month_year}"
-                    date_obj = datetime.date(dtparse(date_str, context_time))
-                    if date_obj:
-                        results.append(date_obj)
-    
-    # Remove duplicates and sort
-    if results:
-        return sorted(list(set(results)))
+        return state
 
-def parseExplicitDate(text: str, context_time):
-    # Extract and parse explicit date strings from a sentence using regex
-    # returns a list of date objects 
+    def extracted(self, mail):
+        result = {key: getattr(mail, key) for key in DATETIME_FIELDS}
+        self.record(mail.id, 'extracted', result = result)
 
-    explicit_date_regexes = [
-        # ISO format: 2023-08-14, 14/08/2023, 14.08.2023
-        r'\b\d{1,4}[-./]\d{1,2}[-./]\d{1,4}\b',
-        
-        # Format: 14th August 2023, August 14th 2023
-        r'\b\d{1,2}(?:th|st|nd|rd)?(?:\s+of)?\s+(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|jun(?:e)?|jul(?:y)?|aug(?:ust)?|sep(?:tember)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)\s+\d{2,4}\b',
-        r'\b(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|jun(?:e)?|jul(?:y)?|aug(?:ust)?|sep(?:tember)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)\s+\d{1,2}(?:th|st|nd|rd)?(?:,?\s+\d{2,4})?\b',
-        
-        # Month and day without year: 14th August, August 14th
-        r'\b\d{1,2}(?:th|st|nd|rd)?(?:\s+of)?\s+(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|jun(?:e)?|jul(?:y)?|aug(?:ust)?|sep(?:tember)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)\b',
-        r'\b(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|jun(?:e)?|jul(?:y)?|aug(?:ust)?|sep(?:tember)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)\s+\d{1,2}(?:th|st|nd|rd)?\b'
-    ]
+def getLedger(path = LEDGER_FILE):
+    return openLedger(accountPath(path))
 
-    results = []
+@lru_cache(maxsize = None)
+def openLedger(path):
+    return Ledger(path)
 
-    parsed_results = []
+def pendingIds(ids, ledger = None, resume = True):
 
-    for regex in explicit_date_regexes:
-        results.extend(re.findall(regex, text))
+    # messages left unfinished by an earlier run first, then the new ones we have not finished yet.
+    # A run made of several listings (backfill pages) only resumes with the first of them
 
-    for result in results:
-        # remove any whitespace and surrounding characters
-        result = result.strip()
-        result = datetime.date(dtparse(result, context_time))
-        if result:
-            parsed_results.append(result)
+    if ledger is None:
+        ledger = getLedger()
 
-    # remove duplicates
-    parsed_results = list(set(parsed_results))
+    resumed = ledger.unfinished() if resume else []
+    seen = set(resumed)
 
-    return parsed_results
+    return resumed + [message_id for message_id in ids if not ledger.finished(message_id) and message_id not in seen]
 
-def parseRelativeDates(text: str, context_time: datetime):
-    # Isolate and parse relative date expressions (like “today", “next Monday”) 
-    # using regex and a date parsing library with a relative base.
-    # returns a list of date objects 
+def fetchMails(service, ids, batchSize = GMAIL_BATCH_SIZE):
 
-    relative_date_regex = r'\b(?:(?:from|on)\s+)?(today|tomorrow|yesterday|this\s+(?:week|weekend)|(?:(?:coming|next)\s+)?(?:monday|tuesday|wednesday|thursday|friday|saturday|sunday)|next\s+(?:week|weekend))\b'
-    
-    matches = re.finditer(relative_date_regex, text, re.IGNORECASE)
-    
-    parsed_results = []
-    
-    for match in matches:
-        result = match.group(0)
-        
-        if not result:
-            continue
+    mails = []
+    fetched = []
 
-        parsed_date = dtparse(result, context_time)
-        
-        if parsed_date:
-            date = datetime.date(parsed_date)
+    ledger = getLedger()
 
-            parsed_results.append(date)
-    
-    return parsed_results
+    with getMetrics().timer('fetch', len(ids)):
+        messages, failed = getMessages(service, ids, batchSize)
 
-def parseTime(text: str):
-    # Extract and parse explicit date strings from a sentence using regex
-    # returns a list of time objects 
+    # a rate limited or failed part is left pending, the next pendingIds resumes it even once
+    # the history checkpoint has moved past it. A deleted message has nothing left to fetch
+    for message_id, error in failed.items():
+        gone = getattr(getattr(error, 'resp', None), 'status', None) in (404, 410)
 
-    time_regexes = [
-        # Standard time: 9:00 am, 9.00 am, 9am
-        r'\b(\d{1,2})(?::|\.)(\d{2})?\s*(am|pm)\b',
-        r'\b(\d{1,2})\s*(am|pm)\b',
-        
-        # 24-hour time: 14:00, 14.00
-        r'\b(\d{1,2})(?::|\.)(\d{2})(?!\s*(?:am|pm))\b',
-        
-        # Time ranges: 9-11am, 9:00-11:00am, 9am-11am
-        r'\b(\d{1,2})(?::(\d{2}))?\s*(?:-|to)\s*(\d{1,2})(?::(\d{2}))?\s*(am|pm)\b',
-        r'\b(\d{1,2})(?::(\d{2}))?\s*(am|pm)\s*(?:-|to)\s*(\d{1,2})(?::(\d{2}))?\s*(am|pm)\b'
-    ]
+        if ledger.record(message_id, 'skipped' if gone else 'pending') == 'failed':
+            print(colored(f"[!] Giving up on message {message_id} after {ledger.maxAttempts} attempts", 'light_red'))
 
-    results = []
+    for msg in messages:
 
-    for i, pattern in enumerate(time_regexes):
-        matches = re.finditer(pattern, text)
-        for match in matches:
+        with getMetrics().timer('parse'):
+            mail = parseMessage(msg)
 
-            groups = match.groups()
-    
-            if i == 0:
-                
-                hour   = int(groups[0])
-                minute = int(groups[1] or 0)
-                period = groups[2]
-                
-                if period == 'pm' and hour < 12:
-                    hour += 12
-                elif period == 'am' and hour == 12:
-                    hour = 0
-                
-                results.append(time(hour, minute))
+        if mail is None:
+            ledger.record(msg['id'], 'skipped')
+            continue
 
-            elif i == 1:
-                
-                hour = int(groups[0])
-                period = groups[1]
+        if ledger.record(msg['id'], 'fetched') == 'failed':
+            print(colored(f"[!] Giving up on \"{mail.subject}\" after {ledger.maxAttempts} attempts", 'light_red'))
+            continue
 
-                if groups[0] == '00' or hour > 12:
-                    continue
-                
-                if period == 'pm' and hour < 12:
-                    hour += 12
-                elif period == 'am' and hour == 12:
-                    hour = 0
+        mails.append(mail)
+        fetched.append(msg['id'])
 
-                results.append(time(hour, 0))
-                
-            elif i == 2:  
+    return mails, fetched
 
-                # 24hr time
-                hour = int(groups[0])
-                minute = int(groups[1] or 0)
+def getMail(creds, maxResults, batchSize = GMAIL_BATCH_SIZE):
 
-                if hour > 24 or minute > 60:
-                    continue
+    try:
+        service = getService("gmail", "v1", creds)
+        try:
+            results = service.users().messages().list(userId = "me", labelIds = ['INBOX'], maxResults = maxResults, q='is:unread newer_than:2d').execute()
+        except Exception as e:
+            print(f"[!] Error occurred while fetching mail: {e}")
+            return []
 
-                results.append(time(hour, minute))
-            
-            elif i == 3:  # Time range (same period)
-                
-                start_hour = int(groups[0])
-                start_minute = int(groups[1] or 0)
-                end_hour = int(groups[2])
-                end_minute = int(groups[3] or 0)
-                period = groups[4]
-                
-                if period == 'pm':
-                    if start_hour < 12:
-                        start_hour += 12
-                    if end_hour < 12:
-                        end_hour += 12
-                elif period == 'am':
-                    if start_hour == 12:
-                        start_hour = 0
-                    if end_hour == 12:
-                        end_hour = 0
-                
-                return [time(start_hour, start_minute), time(end_hour, end_minute)]
+        ids = pendingIds([message['id'] for message in results.get('messages', [])])
+
+        mails, read = fetchMails(service, ids, batchSize)
+
+        if read:
+            markRead(service, read)
+
+        return mails   
+
+    
+    except HttpError as error:
+        print(f"An error occurred: {error}")
+
+def loadHistoryId(path = HISTORY_FILE):
+
+    path = accountPath(path)
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'r') as f:
+        return json.load(f).get('historyId')
+
+def saveHistoryId(historyId, path = HISTORY_FILE):
+
+    path = accountPath(path)
+
+    # write to a temp file first so a crash never leaves a half written checkpoint
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'historyId': historyId}, f)
+
+    os.replace(path + '.tmp', path)
+
+def getHistory(service, historyId):
+
+    # ids of every inbox message added since historyId and the mailbox's current historyId
+    # raises HttpError 404 when historyId is too old for gmail to remember
+
+    ids = []
+    pageToken = None
+
+    while True:
+        results = service.users().history().list(
+            userId = "me",
+            startHistoryId = historyId,
+            historyTypes = ['messageAdded'],
+            labelId = 'INBOX',
+            pageToken = pageToken
+        ).execute()
+
+        for record in results.get('history', []):
+            for added in record.get('messagesAdded', []):
+                message_id = added['message']['id']
+                if message_id not in ids:
+                    ids.append(message_id)
+
+        pageToken = results.get('nextPageToken')
+
+        if not pageToken:
+            return ids, results['historyId']
+
+def listNewMail(service, maxResults, path = HISTORY_FILE):
+
+    # ids added since the saved historyId and the historyId to save once they are handled
+
+    historyId = loadHistoryId(path)
+
+    if historyId:
+        try:
+            return getHistory(service, historyId)
+        except HttpError as error:
+            if error.resp.status != 404:
+                raise
+            print("[!] History checkpoint expired, doing a full sync")
+
+    # take the historyId before listing so nothing that arrives in between is missed
+    historyId = service.users().getProfile(userId = "me").execute()['historyId']
+
+    results = service.users().messages().list(userId = "me", labelIds = ['INBOX'], maxResults = maxResults, q='is:unread newer_than:2d').execute()
+    ids = [message['id'] for message in results.get('messages', [])]
+
+    return ids, historyId
+
+def syncMail(creds, maxResults, batchSize = GMAIL_BATCH_SIZE, path = HISTORY_FILE):
+
+    # Incremental version of getMail, only messages added since the last saved historyId are fetched
+    # so a quiet cycle costs a single history().list call. The checkpoint keeps us from
+    # processing a mail twice, so unlike getMail this never touches the UNREAD label
+
+    try:
+        service = getService("gmail", "v1", creds)
+
+        ids, historyId = listNewMail(service, maxResults, path)
+
+        mails, _ = fetchMails(service, pendingIds(ids), batchSize)
+
+        saveHistoryId(historyId, path)
+
+        return mails
+
+    except HttpError as error:
+        print(f"An error occurred: {error}")
+        return []
+
+def keywordPattern(words):
+
+    # Compile keywords into one regex whose alternation is factored like a trie, so the
+    # scan walks each position of the text once instead of trying every keyword in turn
+
+    trie = {}
+
+    for word in words:
+        node = trie
+        for char in word.lower():
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def build(node):
+        end = '' in node
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+
+        if not branches:
+            return ''
+
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return f'(?:{body})?' if end else body
+
+    return re.compile(r'\b(' + build(trie) + r')\b') if trie else None
+
+class RelevanceFilter:
+    # Cheap first stage classifier, run on fetched mails before any date parsing or gemini calls.
+    # Senders on the allow list are always kept and ones on the deny list always skipped, otherwise
+    # event words in the subject and body raise the score and receipt/newsletter words lower it.
+    # A date in the mail counts like a subject word and a time like a body word, so short notes
+    # with no event words ("book club meets on march 31st at 6pm") still get through.
+    # Mails scoring below threshold are skipped. The lists can be overridden in FILTER_FILE
+
+    # cheap look for a day and month, weekday or today/tomorrow, the real date parsing comes later
+    DATE_HINT = re.compile(r'\b(?:\d{1,2}(?:st|nd|rd|th)?\s+(?:of\s+)?(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\b'
+                           r'|(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\s+\d{1,2}(?:st|nd|rd|th)?\b'
+                           r'|(?:mon|tues|wednes|thurs|fri|satur|sun)day\b|today\b|tomorrow\b)')
+
+    DEFAULTS = {
+        'allow': [],
+        'deny': ['no-reply@accounts.google.com', 'noreply@github.com'],
+        'subject': ['meeting', 'invite', 'invitation', 'event', 'webinar', 'workshop', 'seminar', 'session', 'talk',
+                    'interview', 'deadline', 'schedule', 'rescheduled', 'reminder', 'registration', 'conference', 'exam',
+                    'class', 'lecture', 'orientation', 'hackathon', 'meetup'],
+        'body': ['venue', 'agenda', 'join us', 'rsvp', 'register', 'hall', 'auditorium', 'zoom', 'google meet', 'teams',
+                 'location', 'starts at', 'will be held', 'scheduled', 'deadline', 'attend', 'invite', 'meeting'],
+        'negative': ['otp', 'one time password', 'verification code', 'your order', 'order number', 'invoice', 'receipt', 'payment',
+                     'transaction', 'unsubscribe', 'newsletter', 'shipped', 'delivered', 'refund', 'password reset'],
+        'threshold': 2
+    }
+
+    def __init__(self, config = None):
+        config = {**self.DEFAULTS, **(config or {})}
+
+        self.allow = [sender.lower() for sender in config['allow']]
+        self.deny = [sender.lower() for sender in config['deny']]
+        self.subject = keywordPattern(config['subject'])
+        self.body = keywordPattern(config['body'])
+        self.negative = keywordPattern(config['negative'])
+        self.threshold = config['threshold']
+
+        # (seen, skipped) since the last report, per account so --accounts cycles report their own
+        self.lock = threading.Lock()
+        self.counts = dict()
+
+    @staticmethod
+    def hits(pattern, text):
+        # distinct keywords found, repeating one word doesn't make a mail more relevant
+        return len(set(pattern.findall(text))) if pattern and text else 0
+
+    @staticmethod
+    def listed(sender, entries):
+        # entries are full addresses or domains
+        return any(entry in sender for entry in entries)
+
+    def score(self, mail):
+        sender = mail.sender.lower()
+
+        if self.listed(sender, self.allow):
+            return float('inf')
+
+        if self.listed(sender, self.deny):
+            return float('-inf')
+
+        subject = mail.subject.lower()
+        body = mail.body
+
+        # TIME_HINT is the segmenter's, both run on the lowercased text
+        when = 2 * bool(self.DATE_HINT.search(subject) or self.DATE_HINT.search(body)) + bool(TIME_HINT.search(body))
+
+        return (2 * self.hits(self.subject, subject) + self.hits(self.body, body) + when
+                - 2 * self.hits(self.negative, subject) - self.hits(self.negative, body))
+
+    def relevant(self, mail):
+        keep = self.score(mail) >= self.threshold
+        account = getattr(ACCOUNT, 'name', None)
+
+        with self.lock:
+            seen, skipped = self.counts.get(account, (0, 0))
+            self.counts[account] = (seen + 1, skipped + (not keep))
+
+        return keep
+
+    def report(self):
+        # skip rate of the current account since its last report, one report per cycle
+        with self.lock:
+            seen, skipped = self.counts.pop(getattr(ACCOUNT, 'name', None), (0, 0))
+
+        if seen:
+            print(f"[~] Relevance filter: skipped {skipped} of {seen} mails ({skipped / seen:.0%} skip rate)")
+
+        return seen, skipped
+
+@lru_cache(maxsize = None)
+def getRelevanceFilter(path = FILTER_FILE):
+
+    config = None
+
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            config = json.load(f)
+
+    return RelevanceFilter(config)
+
+def filterMails(mails, relevance = None):
+
+    # mails worth parsing, the rest are parked in the ledger as filtered
+
+    if not RELEVANCE_FILTER:
+        return mails
+
+    if relevance is None:
+        relevance = getRelevanceFilter()
+
+    kept = []
+
+    with getMetrics().timer('filter', len(mails)):
+        for mail in mails:
+            if relevance.relevant(mail):
+                kept.append(mail)
+            else:
+                print(colored(f"[=] Not an event \"{mail.subject}\"", 'light_green'))
+                getLedger().record(mail.id, 'filtered')
+
+    getMetrics().count('mails_skipped', len(mails) - len(kept))
+
+    return kept
+
+# Every date pattern CLEO understands, compiled once into a single alternation
+# so one finditer pass over the text finds and classifies every date.
+# Alternatives are tried in this order at each position, so ranges win over
+# connected dates which win over explicit dates which win over relative ones.
+# Patterns expect lowercase text, like the rest of the extraction code
+
+MONTH = r'(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|jun(?:e)?|jul(?:y)?|aug(?:ust)?|sep(?:tember)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)'
+ORDINAL = r'(?:th|st|nd|rd)?'
+
+DATE_PATTERNS = [
+    # Pattern for 14th - 16th August 2023 or 14-16 August 2023
+    ('range', rf'\b(\d{{1,2}}){ORDINAL}\s*(?:to|-)\s*(\d{{1,2}}){ORDINAL}(?:\s+of)?\s+({MONTH}(?:\s+\d{{2,4}})?)\b'),
+
+    # Pattern for August 14-16, 2023
+    ('range', rf'\b({MONTH})\s+(\d{{1,2}}){ORDINAL}\s*(?:to|-)\s*(\d{{1,2}}){ORDINAL}(?:,?\s+(\d{{2,4}})?)?\b'),
+
+    # Pattern for from 14th August to 16th August 2023
+    ('range', rf'\bfrom\s+(\d{{1,2}}){ORDINAL}\s+({MONTH})\s+to\s+(\d{{1,2}}){ORDINAL}\s+({MONTH}(?:\s+\d{{2,4}})?)\b'),
+
+    # Pattern for "8th & 9th Jan" or "8th and 9th January"
+    ('connected', rf'\b(\d{{1,2}}){ORDINAL}\s*(?:&|and)\s*(\d{{1,2}}){ORDINAL}\s+({MONTH}(?:\s+\d{{2,4}})?)\b'),
+
+    # Pattern for "Jan 8th & 9th" or "January 8th and 9th"
+    ('connected', rf'\b({MONTH})\s+(\d{{1,2}}){ORDINAL}\s*(?:&|and)\s*(\d{{1,2}}){ORDINAL}(?:,?\s+(\d{{2,4}})?)?\b'),
+
+    # Pattern for comma-separated dates like "8th, 9th, and 10th Jan"
+    ('connected', rf'\b(\d{{1,2}}){ORDINAL}(?:\s*,\s*(\d{{1,2}}){ORDINAL})+(?:\s*(?:&|and)\s*(\d{{1,2}}){ORDINAL})?\s+({MONTH}(?:\s+\d{{2,4}})?)\b'),
+
+    # ISO format: 2023-08-14, 14/08/2023, 14.08.2023
+    ('explicit', r'\b\d{1,4}[-./]\d{1,2}[-./]\d{1,4}\b'),
+
+    # Format: 14th August 2023, August 14th 2023
+    ('explicit', rf'\b\d{{1,2}}{ORDINAL}(?:\s+of)?\s+{MONTH}\s+\d{{2,4}}\b'),
+    ('explicit', rf'\b{MONTH}\s+\d{{1,2}}{ORDINAL}(?:,?\s+\d{{2,4}})?\b'),
+
+    # Month and day without year: 14th August, August 14th
+    ('explicit', rf'\b\d{{1,2}}{ORDINAL}(?:\s+of)?\s+{MONTH}\b'),
+    ('explicit', rf'\b{MONTH}\s+\d{{1,2}}{ORDINAL}\b'),
+
+    # Relative dates: today, next monday, this weekend
+    ('relative', r'\b(?:(?:from|on)\s+)?(today|tomorrow|yesterday|this\s+(?:week|weekend)|(?:(?:coming|next)\s+)?(?:monday|tuesday|wednesday|thursday|friday|saturday|sunday)|next\s+(?:week|weekend))\b'),
+]
+
+# Every pattern above starts with one of these words, checking it first lets the
+# scanner skip most positions without trying twelve alternatives at each of them
+DATE_LEAD = r'\b(?=\d|jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec|from|on|today|tomorrow|yesterday|this|coming|next|monday|tuesday|wednesday|thursday|friday|saturday|sunday)'
+
+def compileDatePatterns(patterns):
+
+    # wrap every pattern in its own group and remember where its inner groups
+    # start, match.lastindex then tells us which pattern matched
+
+    alternatives = []
+    index = dict()
+    group = 1
+
+    for number, (kind, pattern) in enumerate(patterns):
+        inner = re.compile(pattern).groups
+        alternatives.append(f'({pattern})')
+        index[group] = (kind, number, group + 1, group + 1 + inner)
+        group += inner + 1
+
+    return re.compile(DATE_LEAD + '(?:' + '|'.join(alternatives) + ')'), index
+
+DATE_SCANNER, DATE_SCANNER_INDEX = compileDatePatterns(DATE_PATTERNS)
+
+# every pattern on its own, to look for the overlapping matches finditer cannot return,
+# tried only where a word starts inside a match
+DATE_PATTERN_REGEXES = [re.compile(DATE_LEAD + pattern) for kind, pattern in DATE_PATTERNS]
+WORD_START = re.compile(r'\b(?=\w)')
+
+def scanDates(text: str):
+    # Single pass over the text, returns a list of matches in the order they appear:
+    # {'kind': 'range' | 'connected' | 'explicit' | 'relative', 'pattern': index into DATE_PATTERNS,
+    #  'text': matched text, 'start': offset, 'groups': the pattern's own groups}
+
+    matches = []
+
+    for match in DATE_SCANNER.finditer(text):
+        kind, number, first, last = DATE_SCANNER_INDEX[match.lastindex]
+        matches.append({
+            'kind': kind,
+            'pattern': number,
+            'text': match.group(0),
+            'start': match.start(),
+            'groups': match.groups()[first - 1:last - 1]
+        })
+
+        # finditer never overlaps, so in "may 2 - 5 june 2025" the match for "may 2 - 5" hides
+        # "2 - 5 june 2025". Earlier patterns of the same kind starting inside this match are
+        # looked for separately so the parsers can still prefer them. Anchored at the words of
+        # this match only, a search running on to the end of the text would make this quadratic
+        earlier = [i for i in range(number) if DATE_PATTERNS[i][0] == kind]
+        starts = [word.start() for word in WORD_START.finditer(text, match.start() + 1, match.end())] if earlier else []
+
+        for i in earlier:
+            other = next(filter(None, (DATE_PATTERN_REGEXES[i].match(text, start) for start in starts)), None)
+
+            if other:
+                matches.append({
+                    'kind': kind,
+                    'pattern': i,
+                    'text': other.group(0),
+                    'start': other.start(),
+                    'groups': other.groups()
+                })
+
+    matches.sort(key = lambda match: match['start'])
+
+    return matches
+
+# Fast path for the shapes DATE_PATTERNS hand over for parsing, anything it does not
+# recognise still goes through dateparser. Answers match dateparser with DATE_ORDER DMY,
+# which only ever looks at the date part of RELATIVE_BASE, so results are cached per base date
+
+DATE_CACHE_SIZE = 4096
+
+MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+RELATIVE_DAYS = {'today': 0, 'tomorrow': 1, 'yesterday': -1, 'this week': 0, 'next week': 7}
+
+FAST_DATE_PATTERNS = [
+    # 14 august 2025, 14th of aug
+    ('dmy', re.compile(rf'(\d{{1,2}}){ORDINAL}(?:\s+of)?\s+({MONTH})(?:\s+(\d{{4}}))?')),
+
+    # august 14th, 2025
+    ('mdy', re.compile(rf'({MONTH})\s+(\d{{1,2}}){ORDINAL}(?:,?\s+(\d{{4}}))?')),
+
+    # 14/08/2025, 14-08-2025, 14.08.2025
+    ('numeric', re.compile(r'(\d{1,2})([-./])(\d{1,2})\2(\d{4})')),
+
+    # today, on monday (dateparser reads a bare weekday as the latest one on or before the base date)
+    ('relative', re.compile(rf'(?:(?:from|on)\s+)?({"|".join(RELATIVE_DAYS)}|{"|".join(WEEKDAYS)})')),
+]
+
+DATE_PARSE_STATS = {'fast': 0, 'dateparser': 0}
+
+def fastParseDate(text: str, base):
+    # returns None when text is not a shape we know, the caller then asks dateparser
+
+    for shape, pattern in FAST_DATE_PATTERNS:
+
+        match = pattern.fullmatch(text)
+
+        if not match:
+            continue
+
+        try:
+            if shape == 'dmy':
+                day, month, year = match.groups()
+                return datetime(int(year or base.year), MONTHS.index(month[:3]) + 1, int(day)).date()
+
+            elif shape == 'mdy':
+                month, day, year = match.groups()
+                return datetime(int(year or base.year), MONTHS.index(month[:3]) + 1, int(day)).date()
+
+            elif shape == 'numeric':
+                day, _, month, year = match.groups()
+                return datetime(int(year), int(month), int(day)).date()
+
+            elif shape == 'relative':
+                word = match.group(1)
+
+                if word in RELATIVE_DAYS:
+                    return base + timedelta(days = RELATIVE_DAYS[word])
+
+                return base - timedelta(days = (base.weekday() - WEEKDAYS.index(word)) % 7)
+
+        except ValueError:
+            # 31 feb and friends, let dateparser decide
+            return None
+
+    return None
+
+@lru_cache(maxsize = DATE_CACHE_SIZE)
+def cachedParseDate(text: str, base):
+
+    result = fastParseDate(text, base)
+
+    if result is not None:
+        DATE_PARSE_STATS['fast'] += 1
+        return result
+
+    DATE_PARSE_STATS['dateparser'] += 1
+
+    parsed = dtparse(text, datetime.combine(base, time.min))
+
+    return datetime.date(parsed) if parsed else None
+
+def parseDate(text: str, context_time = None):
+    # date object for a string matched by DATE_PATTERNS, None if it can't be parsed
+
+    base = datetime.date(context_time or datetime.now())
+
+    return cachedParseDate(' '.join(text.lower().split()), base)
+
+def dateCacheStats():
+
+    info = cachedParseDate.cache_info()
+
+    return {
+        'hits': info.hits,
+        'misses': info.misses,
+        'size': info.currsize,
+        'fast': DATE_PARSE_STATS['fast'],
+        'dateparser': DATE_PARSE_STATS['dateparser']
+    }
+
+def parseDateRange(text: str, context_time, matches = None):
+
+    # Parses sequential multidates such as 14th - 16th august 2025 and 8th to 30th August
+
+    if matches is None:
+        matches = scanDates(text.lower())
+
+    ranges = [match for match in matches if match['kind'] == 'range']
+
+    if not ranges:
+        return None
+
+    # earlier patterns are more specific, prefer them over an earlier position in the text
+    match = min(ranges, key = lambda match: match['pattern'])
+    groups = match['groups']
+
+    if match['pattern'] == 0:
+        day1, day2, month_year = groups
+        date1_str = f"{day1} {month_year}"
+        date2_str = f"{day2} {month_year}"
+
+    elif match['pattern'] == 1:
+        month, day1, day2, year = groups
+        year = year or ''
+        date1_str = f"{day1} {month} {year}"
+        date2_str = f"{day2} {month} {year}"
+    
+    elif match['pattern'] == 2:
+        day1, month1, day2, month2_year = groups
+        date1_str = f"{day1} {month1}"
+        date2_str = f"{day2} {month2_year}"
+
+    date1 = parseDate(date1_str, context_time)
+    date2 = parseDate(date2_str, context_time)
+
+    if not (date1 and date2):
+        return None
+
+    return [date1, date2]
+
+def parseConnectedDates(text: str, context_time, matches = None):
+    """Parse date patterns like "8th & 9th Jan" or "8th and 9th January"."""
+
+    if matches is None:
+        matches = scanDates(text.lower())
+
+    results = []
+    
+    for match in matches:
+
+        if match['kind'] != 'connected':
+            continue
+
+        groups = match['groups']
+        
+        if match['pattern'] == 3:  # 8th & 9th Jan
+            day1, day2, month_year = groups
+            date1_str = f"{day1} {month_year}"
+            date2_str = f"{day2} {month_year}"
             
-            elif i == 4:  # Time range (different periods)
-                start_hour   = int(groups[0])
-                start_minute = int(groups[1] or 0)
-                start_period = groups[2]
-                end_hour     = int(groups[3])
-                end_minute   = int(groups[4] or 0)
-                end_period   = groups[5]
+            date1 = parseDate(date1_str, context_time)
+            date2 = parseDate(date2_str, context_time)
+            
+            if date1 and date2:
+                results.extend([date1, date2])
                 
-                if start_period == 'pm' and start_hour < 12:
-                    start_hour += 12
-                elif start_period == 'am' and start_hour == 12:
-                    start_hour = 0
-                    
-                if end_period == 'pm' and end_hour < 12:
-                    end_hour += 12
-                elif end_period == 'am' and end_hour == 12:
-                    end_hour = 0
+        elif match['pattern'] == 4:  # Jan 8th & 9th
+            month, day1, day2, year = groups
+            year = year or ''
+            date1_str = f"{day1} {month} {year}"
+            date2_str = f"{day2} {month} {year}"
+            
+            date1 = parseDate(date1_str, context_time)
+            date2 = parseDate(date2_str, context_time)
+            
+            if date1 and date2:
+                results.extend([date1, date2])
                 
-                return [time(start_hour, start_minute), time(end_hour, end_minute)]
+        elif match['pattern'] == 5:  # 8th, 9th, and 10th Jan
+            # This is more complex as we have variable number of days
+            days = [g for g in groups[:-1] if g is not None]
+            month_year = groups[-1]
+            
+            for day in days:
+                date_str = f"{day} {month_year}"
+                date_obj = parseDate(date_str, context_time)
+                if date_obj:
+                    results.append(date_obj)
     
+    # Remove duplicates and sort
+    if results:
+        return sorted(list(set(results)))
+
+def parseExplicitDate(text: str, context_time, matches = None):
+    # Extract and parse explicit date strings from a sentence using regex
+    # returns a list of date objects 
+
+    if matches is None:
+        matches = scanDates(text.lower())
+
+    parsed_results = []
+
+    for match in matches:
+
+        if match['kind'] != 'explicit':
+            continue
+
+        # remove any whitespace and surrounding characters
+        result = match['text'].strip()
+        result = parseDate(result, context_time)
+        if result:
+            parsed_results.append(result)
+
     # remove duplicates
-    unique_results = list(set(results))
-    return unique_results
+    parsed_results = list(set(parsed_results))
 
-def fixDateTime(result, context_time):
+    return parsed_results
+
+def parseRelativeDates(text: str, context_time: datetime, matches = None):
+    # Isolate and parse relative date expressions (like “today", “next Monday”) 
+    # using regex and a date parsing library with a relative base.
+    # returns a list of date objects 
+
+    if matches is None:
+        matches = scanDates(text.lower())
+
+    parsed_results = []
+    
+    for match in matches:
+
+        if match['kind'] != 'relative':
+            continue
+
+        result = match['text']
+        
+        if not result:
+            continue
+
+        date = parseDate(result, context_time)
+        
+        if date:
+            parsed_results.append(date)
+    
+    return parsed_results
+
+def parseTime(text: str):
+    # Extract and parse explicit date strings from a sentence using regex
+    # returns a list of time objects 
+
+    time_regexes = [
+        # Standard time: 9:00 am, 9.00 am, 9am
+        r'\b(\d{1,2})(?::|\.)(\d{2})?\s*(am|pm)\b',
+        r'\b(\d{1,2})\s*(am|pm)\b',
+        
+        # 24-hour time: 14:00, 14.00
+        r'\b(\d{1,2})(?::|\.)(\d{2})(?!\s*(?:am|pm))\b',
+        
+        # Time ranges: 9-11am, 9:00-11:00am, 9am-11am
+        r'\b(\d{1,2})(?::(\d{2}))?\s*(?:-|to)\s*(\d{1,2})(?::(\d{2}))?\s*(am|pm)\b',
+        r'\b(\d{1,2})(?::(\d{2}))?\s*(am|pm)\s*(?:-|to)\s*(\d{1,2})(?::(\d{2}))?\s*(am|pm)\b'
+    ]
+
+    results = []
+
+    for i, pattern in enumerate(time_regexes):
+        matches = re.finditer(pattern, text)
+        for match in matches:
+
+            groups = match.groups()
+    
+            if i == 0:
+                
+                hour   = int(groups[0])
+                minute = int(groups[1] or 0)
+                period = groups[2]
+                
+                if period == 'pm' and hour < 12:
+                    hour += 12
+                elif period == 'am' and hour == 12:
+                    hour = 0
+                
+                results.append(time(hour, minute))
+
+            elif i == 1:
+                
+                hour = int(groups[0])
+                period = groups[1]
+
+                if groups[0] == '00' or hour > 12:
+                    continue
+                
+                if period == 'pm' and hour < 12:
+                    hour += 12
+                elif period == 'am' and hour == 12:
+                    hour = 0
+
+                results.append(time(hour, 0))
+                
+            elif i == 2:  
+
+                # 24hr time
+                hour = int(groups[0])
+                minute = int(groups[1] or 0)
+
+                if hour > 24 or minute > 60:
+                    continue
+
+                results.append(time(hour, minute))
+            
+            elif i == 3:  # Time range (same period)
+                
+                start_hour = int(groups[0])
+                start_minute = int(groups[1] or 0)
+                end_hour = int(groups[2])
+                end_minute = int(groups[3] or 0)
+                period = groups[4]
+                
+                if period == 'pm':
+                    if start_hour < 12:
+                        start_hour += 12
+                    if end_hour < 12:
+                        end_hour += 12
+                elif period == 'am':
+                    if start_hour == 12:
+                        start_hour = 0
+                    if end_hour == 12:
+                        end_hour = 0
+                
+                return [time(start_hour, start_minute), time(end_hour, end_minute)]
+            
+            elif i == 4:  # Time range (different periods)
+                start_hour   = int(groups[0])
+                start_minute = int(groups[1] or 0)
+                start_period = groups[2]
+                end_hour     = int(groups[3])
+                end_minute   = int(groups[4] or 0)
+                end_period   = groups[5]
+                
+                if start_period == 'pm' and start_hour < 12:
+                    start_hour += 12
+                elif start_period == 'am' and start_hour == 12:
+                    start_hour = 0
+                    
+                if end_period == 'pm' and end_hour < 12:
+                    end_hour += 12
+                elif end_period == 'am' and end_hour == 12:
+                    end_hour = 0
+                
+                return [time(start_hour, start_minute), time(end_hour, end_minute)]
+    
+    # remove duplicates
+    unique_results = list(set(results))
+    return unique_results
+
+# Segmenting a mail before extraction. Quoted replies, signatures and footers are cut, the rest is
+# split into sentences and every sentence is scored on the dates, times and event words in it.
+# The best ones, up to SEGMENT_MAX_TOKENS, are put back in their original order and only that
+# excerpt is scanned by extractDateTime and sent to gemini, so a date in a signature or in an
+# old quoted message can no longer become the event. Patterns expect lowercase text
+
+# the header of a quoted reply or outlook style original message, the new text of a reply ends here
+QUOTE_START = re.compile(r'^(?:on\b.{0,200}\bwrote:[ \t]*$|-{2,}\s*original message\s*-{2,}[ \t]*$|from:.*\n(?:.*\n){0,2}?sent:.*$)', re.MULTILINE)
+QUOTE_MARK = re.compile(r'^[ \t]*>+[ \t]?', re.MULTILINE)
+
+# from:, sent:, to: lines heading a quoted or forwarded message, their dates are not the event's
+HEADER_LINES = re.compile(r'(?:[ \t]*(?:from|sent|date|to|cc|subject):.*(?:\n|$)|[ \t]*\n)*')
+FORWARD_START = re.compile(r'^-{2,}\s*forwarded message\s*-{2,}[ \t]*$', re.MULTILINE)
+
+# a signature delimiter or mobile sign off, the rest of the mail is cut
+SIGNATURE_START = re.compile(r'^(?:--\s*$|sent from my\b)', re.MULTILINE)
+
+# lines with any of these are boilerplate and dropped
+FOOTER_PHRASES = [
+    'unsubscribe', 'manage preferences', 'manage your preferences', 'view in browser', 'view in your browser',
+    'view this email in your browser', 'you are receiving this', 'you received this', 'privacy policy',
+    'all rights reserved', 'copyright', 'email is confidential', 'message is confidential',
+    'attachments are confidential', 'intended only for', 'intended solely for'
+]
+
+# signatures and footers are only cut in the trailing part of a mail: its last TRAILER_LINES
+# lines, and below the middle unless the text above already has a date. So "hi all\n--\nseminar
+# on 12 april..." keeps its seminar and a phrase early in the mail doesn't lose its line
+TRAILER_LINES = 15
+
+# sentence ends, a period followed by a digit is left alone so "mar. 14" and "10. 30" stay whole
+SENTENCE_END = re.compile(r'[.!?][ \t]+(?=[^\d\s])|\n')
+
+# 9am, 9:30 pm, 14:00. Starts on a digit so the scan can skip ahead to the next one,
+# the lookbehind stands in for the leading \b
+TIME_HINT = re.compile(r'\d(?<!\w\d)\d?(?::\d{2}\b|(?:[:.]\d{2})?\s*(?:am|pm)\b)')
+
+SEGMENT_WORDS = keywordPattern([
+    'venue', 'location', 'where', 'room', 'hall', 'auditorium', 'lab', 'campus', 'building', 'floor', 'online',
+    'zoom', 'google meet', 'teams', 'meeting', 'event', 'workshop', 'seminar', 'session', 'lecture', 'class',
+    'talk', 'webinar', 'conference', 'interview', 'exam', 'deadline', 'schedule', 'scheduled', 'rescheduled',
+    'postponed', 'will be held', 'join us', 'register', 'rsvp', 'agenda', 'starts at'
+])
+
+def stripQuoted(text: str):
+
+    # (reply, quoted), the new text of a mail and the message it quotes, both without their
+    # signature and footer lines. The substring checks are much cheaper than running the
+    # patterns over every mail
+
+    match = None
+
+    if 'wrote:' in text or 'original message' in text or 'sent:' in text:
+        match = QUOTE_START.search(text)
+
+    parts = [text[:match.start()], QUOTE_MARK.sub('', text[match.end():])] if match else [text, '']
+
+    for i, part in enumerate(parts):
+        if i == 1:
+            part = part[HEADER_LINES.match(part).end():]
+
+        # a forwarded message is kept, only its header goes
+        forward = FORWARD_START.search(part) if 'forwarded message' in part else None
+        if forward:
+            part = part[:forward.start()] + part[HEADER_LINES.match(part, forward.end() + 1).end():]
+
+        signature = SIGNATURE_START.search(part, trailerStart(part)) if '--' in part or 'sent from my' in part else None
+        if signature:
+            part = part[:signature.start()]
+
+        if any(phrase in part for phrase in FOOTER_PHRASES):
+            part = dropFooters(part)
+
+        parts[i] = part
+
+    return parts
+
+def trailerStart(text: str):
+
+    # offset where the trailing part of text starts, see TRAILER_LINES. A line starting at or
+    # after it has fewer than TRAILER_LINES lines below it, and more lines above than below
+    # or a date above it. Worked out once per text so the callers' loops stay linear
+
+    newlines = [match.start() for match in re.finditer('\n', text)]
+    total = len(newlines)
+
+    last = newlines[total - TRAILER_LINES] + 1 if total >= TRAILER_LINES else 0
+    middle = newlines[total // 2] + 1 if total else len(text) + 1
+
+    date = DATE_SCANNER.search(text, 0, middle)
+    return max(last, min(middle, date.end() if date else middle))
+
+def dropFooters(text: str):
+
+    # text without the trailing lines that hold one of FOOTER_PHRASES
+
+    lines = set()
+    trailer = trailerStart(text)
+
+    for phrase in FOOTER_PHRASES:
+        at = text.find(phrase, trailer)
+
+        while at != -1:
+            begin = text.rfind('\n', 0, at) + 1
+            end = text.find('\n', at)
+            end = len(text) if end == -1 else end + 1
+
+            if begin >= trailer:
+                lines.add((begin, end))
+
+            at = text.find(phrase, end)
+
+    kept = []
+    start = 0
+
+    for begin, end in sorted(lines):
+        kept.append(text[start:max(start, begin)])
+        start = max(start, end)
+
+    kept.append(text[start:])
+
+    return ''.join(kept)
+
+def splitSegments(text: str):
+    # (start, end) offsets of every sentence or line
+    spans = []
+    start = 0
+
+    for match in SENTENCE_END.finditer(text):
+        # the period stays with its sentence
+        end = match.start() + (text[match.start()] != '\n')
+        if not text[start:end].isspace() and end > start:
+            spans.append((start, end))
+        start = match.end()
+
+    if start < len(text) and not text[start:].isspace():
+        spans.append((start, len(text)))
+
+    return spans
+
+def scoreSegments(text: str, spans):
+
+    # dates count most, then times, then distinct event and location words. Each pattern
+    # runs once over the whole text and its matches are handed to the segment they start in
+
+    starts = [start for start, end in spans]
+    scores = [0] * len(spans)
+    words = [set() for _ in spans]
+
+    for pattern, weight in ((DATE_SCANNER, 3), (TIME_HINT, 2)):
+        for match in pattern.finditer(text):
+            scores[bisect.bisect_right(starts, match.start()) - 1] += weight
+
+    for match in SEGMENT_WORDS.finditer(text):
+        words[bisect.bisect_right(starts, match.start()) - 1].add(match.group(0))
+
+    return [score + len(found) for score, found in zip(scores, words)]
+
+def selectSegments(text: str, budget):
+
+    # the best scoring segments of text within budget tokens, in their original order
+
+    spans = splitSegments(text)
+    scored = [(score, span) for score, span in zip(scoreSegments(text, spans), spans) if score > 0]
+
+    picked = []
+    tokens = 0
+
+    for score, (start, end) in sorted(scored, key = lambda entry: (-entry[0], entry[1])):
+        end = min(end, start + budget * 4)
+        cost = estimateTokens(text[start:end])
+
+        if picked and tokens + cost > budget:
+            continue
+
+        picked.append((start, end))
+        tokens += cost
+
+    return '\n'.join(text[start:end] for start, end in sorted(picked))
+
+def segmentText(text: str, budget = SEGMENT_MAX_TOKENS):
+
+    # the event relevant excerpt of a lowercased mail body, see QUOTE_START above
+
+    if not text:
+        return ''
+
+    reply, quoted = stripQuoted(text)
+
+    # a reply without a date ("see you there", "see you at 5pm!") leaves the event's date to
+    # the message it quotes, which is read after the reply so the reply's own time comes first
+    if quoted and not DATE_SCANNER.search(reply):
+        reply = reply + '\n' + quoted
+
+    # short mails go through whole, dropping their other sentences saves nothing
+    # and could lose a location that is on a line of its own
+    if estimateTokens(reply) <= budget:
+        return reply
+
+    return selectSegments(reply, budget) or reply[:budget * 4]
+
+def fixDateTime(result, context_time):
+
+    today = context_time.date()
+
+    if result['startdate'] and not result['enddate']:
+        result['enddate'] = result['startdate']
+    
+    # If only enddate use today as startdate
+    if not result['startdate'] and result['enddate']:
+        result['startdate'] = today
+    
+    # If dates are in wrong order, swap them
+    if result['startdate'] and result['enddate'] and result['startdate'] > result['enddate']:
+        result['startdate'], result['enddate'] = result['enddate'], result['startdate']
+    
+    # Not sure about this
+    # If only one time is found early in the day, assume starttime
+    # and add a default duration (e.g., 1 hour)
+    if result['starttime'] and not result['endtime']:
+        hour = result['starttime'].hour
+        minute = result['starttime'].minute
+        # If time is before 1pm, assume it's a start time and add 1 hour
+        if hour < 13:
+            result['endtime'] = time((hour + 1) % 24, minute)
+
+    # If times are in wrong order, swap them
+    if result['starttime'] and result['endtime']:
+        start_minutes = result['starttime'].hour * 60 + result['starttime'].minute
+        end_minutes = result['endtime'].hour * 60 + result['endtime'].minute
+        
+        # Only swap if end is earlier and not likely a next-day event
+        if end_minutes < start_minutes and (start_minutes - end_minutes) < 720:
+            result['starttime'], result['endtime'] = result['endtime'], result['starttime']
+    
+    if result['starttime'] and not result['endtime']:
+        result['endtime'] = result['starttime']
+            
+    return None
+def extractDateTime(mails):
+    for mail in mails:
+        context_time = mail.when or datetime.now()
+
+        # parseMessage already lowercased the body, the excerpt is all that is scanned
+        mail.excerpt = segmentText(mail.body)
+        full_text = f"{mail.subject.lower()} {mail.excerpt}"
+
+        datetime_info = {
+            'startdate': None,
+            'enddate': None,
+            'starttime': None,
+            'endtime': None,
+            'daily': None
+        }
+
+        matches = scanDates(full_text)
+
+        date_range = parseDateRange(full_text, context_time, matches)
+
+        if date_range:
+            datetime_info['startdate'] = date_range[0]
+            datetime_info['enddate'] = date_range[1]
+            datetime_info['daily'] = True
+        else:
+            # Try to parse connected dates (with &, and, or commas)
+            connected_dates = parseConnectedDates(full_text, context_time, matches)
+            
+            if connected_dates:
+                datetime_info['startdate'] = connected_dates[0]
+                datetime_info['enddate'] = connected_dates[-1]
+                # If we have multiple specific dates, they might not be daily events
+                datetime_info['daily'] = False
+                # Store all dates for multi-day handling later
+                datetime_info['all_dates'] = connected_dates
+            else:
+                # Try to find individual dates
+                dates = parseExplicitDate(full_text, context_time, matches)
+                
+                if not dates:
+                    # Try relative dates
+                    dates = parseRelativeDates(full_text, context_time, matches)
+                
+                if dates:
+                    dates.sort()
+                    datetime_info['startdate'] = dates[0]
+                    datetime_info['enddate'] = dates[-1]
+        
+        times = parseTime(full_text)
+        if times:
+            times.sort()
+            datetime_info['starttime'] = times[0]
+            datetime_info['endtime'] = times[-1] if len(times) > 1 else None
+
+        fixDateTime(datetime_info, context_time)
+
+        for key, value in datetime_info.items():
+            setattr(mail, key, value)
+
+def extractChunk(mails):
+    # runs in a worker process, only the extracted fields are sent back
+    extractDateTime(mails)
+    return [{key: getattr(mail, key) for key in DATETIME_FIELDS + ['excerpt']} for mail in mails]
+
+def extractDateTimeParallel(mails, workers = EXTRACT_WORKERS, chunkSize = EXTRACT_CHUNK_SIZE):
+
+    # extractDateTime spread over a process pool chunkSize mails at a time, for large backlogs.
+    # Fills in the same fields on the same records as the serial version
+
+    if workers <= 1 or len(mails) <= chunkSize:
+        extractDateTime(mails)
+        return
+
+    chunks = [mails[i:i + chunkSize] for i in range(0, len(mails), chunkSize)]
+
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        for chunk, results in zip(chunks, executor.map(extractChunk, chunks)):
+            for mail, result in zip(chunk, results):
+                for key, value in result.items():
+                    setattr(mail, key, value)
+
+def extractLocation(text):
+
+    location_regex = r'\b(?:in|venue:?|at|location:?|where:?)(?:\s+the)?\s+([\w\s,()\-]+?)(?=\r|\n|$|-|\.)'
+
+    results = re.findall(location_regex, text)
+
+    if results:
+        longest_match = sorted(results, key=len)[-1]
+        return longest_match.strip()
+
+    else:
+        return ''
+
+class RateLimiter:
+    # token bucket, rate calls every per seconds with bursts of at most burst calls
+
+    def __init__(self, rate, per = 60, burst = 1):
+        self.capacity = burst
+        self.tokens = burst
+        self.fill = rate / per
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # blocks until a call is allowed
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                delay = (1 - self.tokens) / self.fill
+
+            sleep(delay)
+
+GEMINI_LIMITER = RateLimiter(GEMINI_RPM, 60, GEMINI_MAX_IN_FLIGHT)
+
+@lru_cache(maxsize = None)
+def getGeminiClient(path = GEMINI_KEY_FILE):
+
+    # one client for the whole process, None when there is no api key
+
+    from google import genai
+    from google.genai import types
+
+    if API_ENDPOINT and not API_ENDPOINT_AUTH:
+        return genai.Client(api_key = "offline", http_options = types.HttpOptions(base_url = API_ENDPOINT))
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'r') as f:
+        api_key = f.read().strip()
+
+    if API_ENDPOINT:
+        return genai.Client(api_key = api_key, http_options = types.HttpOptions(base_url = API_ENDPOINT))
+
+    return genai.Client(
+        api_key = api_key
+    )
+
+def isRetryable(error):
+    # rate limited or a server side error
+    code = getattr(error, 'code', None)
+    return isinstance(code, int) and (code == 429 or code >= 500)
+
+def withRetries(call, retries = GEMINI_RETRIES, limiter = GEMINI_LIMITER):
+
+    # call() under the rate limiter, retrying 429s and 5xxs with exponential backoff and jitter
+
+    for attempt in range(retries + 1):
+
+        limiter.acquire()
+        start = monotonic()
+
+        try:
+            result = call()
+        except Exception as error:
+            getMetrics().count('api_requests', api = 'gemini', status = getattr(error, 'code', 'error'))
+
+            if attempt == retries or not isRetryable(error):
+                raise
+
+            getMetrics().count('api_retries', api = 'gemini')
+
+            delay = GEMINI_BACKOFF * 2 ** attempt + random.uniform(0, GEMINI_BACKOFF)
+            print(colored(f"[!] Gemini returned {error.code}, retrying in {delay:.1f}s", 'light_red'))
+            sleep(delay)
+            continue
+
+        getMetrics().observe('api', monotonic() - start, api = 'gemini')
+        getMetrics().count('api_requests', api = 'gemini', status = 200)
+
+        return result
+
+def generateTitleLocation(mail, client = None):
+
+    if client is None:
+        client = getGeminiClient()
+
+    if client is None:
+        return None
+
+    from google.genai import types
+
+    model = GEMINI_MODEL
+    contents = [
+        types.Content(
+            role="user",
+            parts=[
+                types.Part.from_text(text=f"""Extract event details from the following text. Your task is to:
+                                                Generate the event title (Be as specific as possible).
+                                                Determine the event location.
+
+                                                Respond with only one line in the following format:
+
+                                                [title]|[location]
+
+                                                Where:
+                                                    [title]: The event's name from the text.
+                                                    [location]: The location where the event takes place.
+
+                                                {mail}
+                                            """),
+            ],
+        ),
+    ]
+    generate_content_config = types.GenerateContentConfig(
+        temperature=0.5,
+        top_p=0.95,
+        top_k=40,
+        max_output_tokens=8192,
+        response_mime_type="text/plain",
+    )
+
+    def call():
+
+        title = ""
+
+        for chunk in client.models.generate_content_stream(
+            model=model,
+            contents=contents,
+            config=generate_content_config,
+            ):
+            
+            title += chunk.text
+
+        return title
+
+    return withRetries(call).strip()
+
+class TitleCache:
+    # On disk cache of title/location answers keyed by a hash of the normalized mail excerpt,
+    # PROMPT_VERSION and GEMINI_MODEL, so forwarded and repeated announcements don't cost
+    # another request. Entries expire after ttl seconds and the least recently used ones
+    # are dropped once there are more than size of them
+
+    def __init__(self, path = TITLE_CACHE_FILE, ttl = TITLE_CACHE_TTL, size = TITLE_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS titles (key TEXT PRIMARY KEY, title TEXT, location TEXT, created REAL, used REAL)")
+        self.evict()
+
+    def key(self, body):
+        normalized = ' '.join(body.lower().split())
+        return hashlib.sha256(f"{PROMPT_VERSION}|{GEMINI_MODEL}|{normalized}".encode()).hexdigest()
+
+    def get(self, body):
+        # (title, location) or None
+        key = self.key(body)
+
+        with self.lock:
+            row = self.db.execute("SELECT title, location FROM titles WHERE key = ? AND created > ?", (key, time_now() - self.ttl)).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.db.execute("UPDATE titles SET used = ? WHERE key = ?", (time_now(), key))
+            self.db.commit()
+
+        return row
+
+    def put(self, body, title, location):
+        key = self.key(body)
+
+        with self.lock:
+            now = time_now()
+            self.db.execute("INSERT OR REPLACE INTO titles VALUES (?, ?, ?, ?, ?)", (key, title, location, now, now))
+            self.db.commit()
+            self.writes += 1
+
+        if self.writes % 100 == 0:
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            self.db.execute("DELETE FROM titles WHERE created <= ?", (time_now() - self.ttl,))
+            self.db.execute("DELETE FROM titles WHERE key NOT IN (SELECT key FROM titles ORDER BY used DESC LIMIT ?)", (self.size,))
+            self.db.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+
+        with self.lock:
+            entries = self.db.execute("SELECT COUNT(*) FROM titles").fetchone()[0]
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries
+        }
+
+@lru_cache(maxsize = None)
+def getTitleCache(path = TITLE_CACHE_FILE):
+    return TitleCache(path)
+
+def printTitleCacheStats():
+    stats = getTitleCache().stats()
+    print(f"[~] Title cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate, {stats['entries']} entries)")
+
+def estimateTokens(text):
+    # roughly four characters per token, good enough to keep prompts under budget
+    return len(text) // 4 + 1
+
+def packMails(mails, size = GEMINI_BATCH_SIZE, budget = GEMINI_BATCH_TOKENS):
+
+    # split mails into batches of at most size mails and budget tokens,
+    # a mail larger than the budget gets a batch of its own
+
+    batches = []
+    batch = []
+    tokens = 0
+
+    for mail in mails:
+        cost = estimateTokens(mail.excerpt)
+
+        if batch and (len(batch) == size or tokens + cost > budget):
+            batches.append(batch)
+            batch = []
+            tokens = 0
+
+        batch.append(mail)
+        tokens += cost
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+def generateTitleLocations(bodies, client = None):
+
+    # one request for several mails, bodies maps an id to the mail excerpt
+    # returns {id: (title, location)} for every id the model answered properly
+
+    if client is None:
+        client = getGeminiClient()
+
+    if client is None:
+        return {}
+
+    from google.genai import types
+
+    emails = "\n".join(f'<email id="{mail_id}">\n{body}\n</email>' for mail_id, body in bodies.items())
+
+    contents = [
+        types.Content(
+            role="user",
+            parts=[
+                types.Part.from_text(text=f"""Extract event details from each of the following emails. For every email:
+                                                Generate the event title (Be as specific as possible).
+                                                Determine the event location.
+
+                                                Respond with only a JSON object that maps every email id to an object:
+
+                                                {{"<id>": {{"title": "<title>", "location": "<location>"}}}}
+
+                                                Where:
+                                                    title: The event's name from the email.
+                                                    location: The location where the event takes place, empty if there is none.
+
+                                                {emails}
+                                            """),
+            ],
+        ),
+    ]
+    generate_content_config = types.GenerateContentConfig(
+        temperature=0.5,
+        top_p=0.95,
+        top_k=40,
+        max_output_tokens=8192,
+        response_mime_type="application/json",
+    )
+
+    def call():
+        return client.models.generate_content(
+            model=GEMINI_MODEL,
+            contents=contents,
+            config=generate_content_config,
+        ).text
+
+    try:
+        answer = json.loads(withRetries(call))
+    except Exception as e:
+        print(colored(f"[!] Batched title and location request failed: {e}", 'light_red'))
+        return {}
+
+    if not isinstance(answer, dict):
+        return {}
+
+    results = dict()
+
+    for mail_id in bodies:
+        entry = answer.get(mail_id)
+
+        if not isinstance(entry, dict):
+            continue
+
+        title = entry.get('title')
+        location = entry.get('location') or ''
+
+        if isinstance(title, str) and title.strip() and isinstance(location, str):
+            results[mail_id] = (title.strip(), location.strip())
+
+    return results
+
+def enrichBatch(mails, client = None, cache = None):
+
+    # enrich a batch of mails with one request, mails the model skipped or
+    # answered badly go through enrichMail one at a time
+
+    if cache is None:
+        cache = getTitleCache()
+
+    pending = []
+
+    for mail in mails:
+        if not (mail.startdate or mail.starttime):
+            continue
+
+        cached = cache.get(mail.excerpt)
+
+        if cached:
+            mail.title, mail.location = cached
+        else:
+            pending.append(mail)
+
+    if not pending:
+        return
+
+    results = generateTitleLocations({f"m{i}": mail.excerpt for i, mail in enumerate(pending)}, client)
+
+    for i, mail in enumerate(pending):
+        if f"m{i}" in results:
+            mail.title, mail.location = results[f"m{i}"]
+            cache.put(mail.excerpt, mail.title, mail.location)
+        else:
+            # already looked up above, going to the cache again would count a second miss
+            enrichMail(mail, client, cache, lookup = False)
+
+def enrichMail(mail, client = None, cache = None, lookup = True):
+
+    if not (mail.startdate or mail.starttime):
+        return
+
+    if cache is None:
+        cache = getTitleCache()
+
+    cached = cache.get(mail.excerpt) if lookup else None
+
+    if cached:
+        mail.title, mail.location = cached
+        return
+
+    try:
+        mail.title, mail.location = generateTitleLocation(mail.excerpt, client).split('|')
+        cache.put(mail.excerpt, mail.title, mail.location)
+    except:
+        print(colored(f"[!] Could not generate title and location for {mail.subject}", 'light_red'))
+        mail.title = mail.subject
+        mail.location = extractLocation(mail.excerpt)
+
+def extractTitleLocation(mails, client = None, maxInFlight = GEMINI_MAX_IN_FLIGHT, batched = False):
+
+    # mails are enriched on a thread pool, GEMINI_LIMITER keeps us within the model's quota.
+    # batched packs several mails into each request, see packMails
+
+    from tqdm import tqdm
+
+    with ThreadPoolExecutor(max_workers = maxInFlight) as executor:
+        if batched:
+            batches = packMails([mail for mail in mails if mail.startdate or mail.starttime])
+            for _ in tqdm(executor.map(inAccount(lambda batch: enrichBatch(batch, client)), batches), total = len(batches)):
+                pass
+        else:
+            for _ in tqdm(executor.map(inAccount(lambda mail: enrichMail(mail, client)), mails), total = len(mails)):
+                pass
+
+class CalendarIndex:
+    # Local copy of the primary calendar for the windows we have asked about. Events are kept
+    # sorted by start time, so a conflict check is a bisect over the index instead of an
+    # events().list call. Only windows that were never loaded are fetched from the API
+
+    def __init__(self, service, tz = datetime.now().astimezone().tzinfo):
+        self.service = service
+        self.tz = tz
+        self.starts = []
+        self.events = []
+        self.ids = set()
+        self.longest = timedelta(0)
+        self.lo = None
+        self.hi = None
+
+    def bounds(self, event):
+        # start and end of a calendar event as aware datetimes
+        start = event['start'].get('dateTime') or event['start'].get('date')
+        end = event['end'].get('dateTime') or event['end'].get('date')
+        return self.toDatetime(start), self.toDatetime(end)
+
+    def toDatetime(self, value):
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+
+        if not isinstance(value, datetime):
+            value = datetime.combine(value, time.min)
+
+        return value.astimezone(self.tz)
+
+    def fetch(self, timeMin, timeMax):
+        pageToken = None
+
+        while True:
+            results = self.service.events().list(
+                calendarId='primary',
+                timeMin=timeMin.isoformat(),
+                timeMax=timeMax.isoformat(),
+                singleEvents=True,
+                orderBy='startTime',
+                pageToken=pageToken
+            ).execute()
+
+            for event in results.get('items', []):
+                self.add(event)
+
+            pageToken = results.get('nextPageToken')
+
+            if not pageToken:
+                return
+
+    def load(self, timeMin, timeMax):
+        # make sure [timeMin, timeMax) is in the index, the loaded window only ever grows
+        if self.lo is None:
+            self.fetch(timeMin, timeMax)
+            self.lo, self.hi = timeMin, timeMax
+            return
+
+        if timeMin < self.lo:
+            self.fetch(timeMin, self.lo)
+            self.lo = timeMin
+
+        if timeMax > self.hi:
+            self.fetch(self.hi, timeMax)
+            self.hi = timeMax
+
+    def instances(self, event):
+        # (start, end) of every occurrence. Listed events are already expanded by singleEvents,
+        # the daily recurrences createEvent makes for date ranges get one entry per day
+        start, end = self.bounds(event)
+        count = 1
+
+        for rule in event.get('recurrence') or []:
+            match = re.fullmatch(r'RRULE:FREQ=DAILY;COUNT=(\d+)', rule)
+            if match:
+                count = max(1, int(match.group(1)))
+
+        return [(start + timedelta(days = day), end + timedelta(days = day)) for day in range(count)]
+
+    def add(self, event):
+        if event.get('id') in self.ids:
+            return
+
+        for start, end in self.instances(event):
+            i = bisect.bisect_right(self.starts, start)
+
+            self.starts.insert(i, start)
+            self.events.insert(i, (start, end, event))
+            self.longest = max(self.longest, end - start)
+
+        self.ids.add(event.get('id'))
+
+    def remove(self, event):
+        for start, _ in self.instances(event):
+            i = bisect.bisect_left(self.starts, start)
+
+            while i < len(self.starts) and self.starts[i] == start:
+                if self.events[i][2].get('id') == event.get('id'):
+                    del self.starts[i]
+                    del self.events[i]
+                    break
+                i += 1
+
+        self.ids.discard(event.get('id'))
+
+    def conflicts(self, timeMin, timeMax):
+        # events overlapping [timeMin, timeMax), same rule as events().list
+        self.load(timeMin, timeMax)
+
+        # nothing starting before timeMin - longest can still be running at timeMin
+        lo = bisect.bisect_left(self.starts, timeMin - self.longest)
+        hi = bisect.bisect_left(self.starts, timeMax)
+
+        return [event for start, end, event in self.events[lo:hi] if end > timeMin]
+
+def calendarSpan(mails, tz = datetime.now().astimezone().tzinfo):
+
+    # smallest window holding every date found in mails, None if there are none
+
+    dates = []
+
+    for mail in mails:
+        dates.extend(date for date in [mail.startdate, mail.enddate] + (mail.all_dates or []) if date)
+
+    if not dates:
+        return None
+
+    return datetime.combine(min(dates), time.min).astimezone(tz), datetime.combine(max(dates), time.max).astimezone(tz)
+
+class CalendarWriter:
+    # Collects the calendar inserts and deletes of a cycle and sends them as http batch requests.
+    # Inserts carry a client generated event id, which puts them in the index straight away.
+    # For mails from gmail the id is derived from the message id and the event's start, so
+    # inserting the same event again (a retry, or a mail resumed from the ledger) gets a 409
+    # instead of creating a duplicate
+
+    def __init__(self, service, index = None, batchSize = CALENDAR_BATCH_SIZE, retries = CALENDAR_RETRIES):
+        self.service = service
+        self.index = index
+        self.batchSize = batchSize
+        self.retries = retries
+        self.pending = dict()
+
+    @staticmethod
+    def eventId(event, mail):
+        # the id an insert of event for mail gets, None when it is random
+        if not (mail and mail.id):
+            return None
+
+        start = event['start'].get('dateTime') or event['start'].get('date')
+        return hashlib.sha256(f"{mail.id}|{start}".encode()).hexdigest()[:32]
+
+    def insert(self, event, mail):
+        event['id'] = self.eventId(event, mail) or uuid.uuid4().hex
+
+        self.pending[event['id']] = ('insert', event, mail)
+
+        if self.index is not None:
+            self.index.add(event)
+
+    def delete(self, event):
+        if self.index is not None:
+            self.index.remove(event)
+
+        # deleting something queued this cycle just means not inserting it
+        if self.pending.get(event.get('id'), ('delete',))[0] == 'insert':
+            del self.pending[event['id']]
+            return
+
+        self.pending['delete-' + event['id']] = ('delete', event, None)
+
+    def discard(self, mail):
+        # take back the inserts queued for mail, when only some of its events could be queued
+        for key, (kind, event, owner) in list(self.pending.items()):
+            if kind == 'insert' and owner is mail:
+                del self.pending[key]
+
+                if self.index is not None:
+                    self.index.remove(event)
+
+    def request(self, kind, event):
+        if kind == 'insert':
+            return self.service.events().insert(calendarId='primary', body=event)
+        return self.service.events().delete(calendarId='primary', eventId=event['id'])
+
+    def flush(self):
+
+        # send everything queued, retrying only the requests that failed. Requests that still
+        # fail stay queued for the next flush, their mails are left unfinished in the ledger.
+        # returns [(mail, links, event ids)] for every mail that had inserts queued
+
+        added = dict()
+        todo = list(self.pending)
+
+        for kind, event, mail in self.pending.values():
+            if kind == 'insert':
+                added.setdefault(id(mail), (mail, [], []))
+
+        for attempt in range(self.retries + 1):
+
+            failed = []
+            answered = set()
+
+            def callback(request_id, response, exception):
+                kind, event, mail = self.pending[request_id]
+                answered.add(request_id)
+
+                if exception is not None:
+                    status = getattr(getattr(exception, 'resp', None), 'status', None)
+
+                    # already gone, or already created by an earlier attempt or run
+                    if not ((kind == 'delete' and status in (404, 410)) or (kind == 'insert' and status == 409)):
+                        failed.append(request_id)
+                        return
+
+                if kind == 'insert':
+                    added[id(mail)][1].append(response.get("htmlLink") if response else None)
+                    added[id(mail)][2].append(event['id'])
+
+                    if self.index is not None and response:
+                        self.index.remove(event)
+                        self.index.add(response)
+
+            for i in range(0, len(todo), self.batchSize):
+
+                batch = self.service.new_batch_http_request(callback = callback)
+
+                chunk = todo[i:i + self.batchSize]
+
+                for request_id in chunk:
+                    kind, event, _ = self.pending[request_id]
+                    batch.add(self.request(kind, event), request_id = request_id)
+
+                try:
+                    batch.execute()
+                except (HttpError, httplib2.HttpLib2Error, OSError) as error:
+                    # the whole batch request failed, nothing in it without an answer was done
+                    print(colored(f"[!] Calendar batch request failed: {error}", 'light_red'))
+                    failed.extend(request_id for request_id in chunk if request_id not in answered)
+
+            todo = failed
+
+            if not todo:
+                break
+
+            if attempt < self.retries:
+                getMetrics().count('api_retries', len(todo), api = 'calendar')
+                print(colored(f"[!] {len(todo)} calendar requests failed, retrying...", 'light_red'))
+                sleep(CALENDAR_BACKOFF * 2 ** attempt)
+
+        for request_id in todo:
+            kind, event, mail = self.pending[request_id]
+            print(colored(f"[!] Could not {kind} \"{event.get('summary', 'No Title')}\", keeping it for the next flush", 'light_red'))
+
+        if todo:
+            getMetrics().count('calendar_failed', len(todo))
+
+        self.pending = {request_id: self.pending[request_id] for request_id in todo}
+
+        return list(added.values())
+
+def insertEvent(service, event, conflict_resolution = 'ask_user', tz = datetime.now().astimezone().tzinfo, index = None, writer = None, mail = None):
+
+    if event['start'].get('dateTime')   :
+        timeMin = event['start']['dateTime'].astimezone(tz)
+        timeMax = event['end']['dateTime'].astimezone(tz)
+    elif event['start'].get('date'):
+        timeMin = datetime.combine(event['start']['date'], time.min).astimezone(tz)
+        timeMax = datetime.combine(event['end']['date'], time.max).astimezone(tz)
+
+    if event['start'].get('dateTime'):
+        try:
+            event['start']['dateTime'] = event['start']['dateTime'].isoformat()
+            event['end']['dateTime'] = event['end']['dateTime'].isoformat()
+        except:
+            event['start']['dateTime'] = event['start']['dateTime']
+            event['end']['dateTime'] = event['end']['dateTime']
+    else:
+        try:
+            event['start']['date'] = event['start']['date'].isoformat()
+            event['end']['date'] = event['end']['date'].isoformat()
+        except:
+            # SOMETIMES THESE DECIDE TO IDENTIFY AS A STRING... I DO NOT KNOW WHY!!!!!!!!!!!!
+            event['start']['date'] = event['start']['date']
+            event['start']['date'] = event['start']['date']
+
+    if index is not None:
+        conflicts = index.conflicts(timeMin, timeMax)
+    else:
+        events_result = service.events().list(
+                        calendarId='primary',
+                        timeMin=timeMin.isoformat(),
+                        timeMax=timeMax.isoformat(),
+                        singleEvents=True,
+                        orderBy='startTime'
+                    ).execute()
+
+        conflicts = events_result.get('items', [])
+
+    # a mail resumed after a crash finds the event it already created, that is not a conflict
+    # and deleting it would remove the very event the insert below only gets a 409 for
+    if writer is not None:
+        ownId = writer.eventId(event, mail)
+        conflicts = [conflict for conflict in conflicts if ownId is None or conflict.get('id') != ownId]
+
+    if conflicts:
+        print(colored("[!] Conflicting events found:", 'light_red'))
+
+        for conflict in conflicts:
+            
+            summary = conflict.get('summary', 'No Title')
+            start = conflict['start']
+            end = conflict['end']
+
+            print(f"- {summary}: starts at {start} and ends at {end}")
+
+        while True:
+
+            if conflict_resolution == "1":
+                print(colored("[=] Keeping old events. New event will not be added.", 'light_green'))
+                return None
+            
+            elif conflict_resolution == "2":
+                # Delete conflicting events.
+                for conflict in conflicts:
+                    if writer is not None:
+                        writer.delete(conflict)
+                        continue
+
+                    event_id = conflict.get('id')
+                    service.events().delete(calendarId='primary', eventId=event_id).execute()
+
+                    if index is not None:
+                        index.remove(conflict)
+                        
+                print(colored("[-] Old conflicting events deleted. Proceeding to add new event.", 'light_green'))
+                break
+            
+            elif conflict_resolution == "3":
+                print(colored("[+] Adding new event alongside existing conflicting events.", 'light_green'))
+                break
+            
+            else:
+                conflict_resolution = ask("1: Keep old\n2: Keep new\n3: Keep both\nOption: ").strip()
+    
+    if writer is not None:
+        # sent with the rest of the cycle by writer.flush()
+        writer.insert(event, mail)
+        return None
+
+    event = service.events().insert(calendarId='primary', body=event).execute()
+
+    if index is not None:
+        index.add(event)
+
+    return event.get("htmlLink")
+
+def createEvent(mail, date = None, local_zone = 'Asia/Kolkata'):
+
+    event = {
+        'summary': mail.title,
+        'description': mail.subject,
+        'location': mail.location
+    }
+
+    if date is not None:
+        event['start'] = {}
+        event['end'] = {}
+
+        if mail.starttime is None:
+            event['start']['date'] = date
+            event['start']['timeZone'] = local_zone
+            event['end']['date'] = date
+            event['end']['timeZone'] = local_zone
+
+        else:
+            event['start']['dateTime'] = datetime.combine(date, mail.starttime)
+            event['end']['dateTime']   = datetime.combine(date, mail.endtime)
+            event['start']['timeZone'] = local_zone
+            event['end']['timeZone'] = local_zone
+
+    else:
+        if mail.starttime is None:
+            event['start'] = {
+                'date': mail.startdate,
+                'timeZone': local_zone
+            }
+            event['end'] = {
+                'date': mail.enddate,
+                'timeZone': local_zone
+            }
+        else:
+            event['start'] = {
+                'dateTime': datetime.combine(mail.startdate, mail.starttime),
+                'timeZone': local_zone
+            }
+            event['end'] = {
+                'dateTime': datetime.combine(mail.enddate, mail.endtime),
+                'timeZone': local_zone
+            }
+
+    # when creating an event for a date range,
+    # we dont want the event to span from say Saturday 8 am to Sunday 10am
+    # we want it from Saturday 8am to 10am and then Sunday again from 8am to 10am
+    # this is where the recurrence flag comes in
+
+    if mail.daily:
+        if mail.starttime is None:
+            event['start'] = {
+                'date': mail.startdate,
+                'timeZone': local_zone
+            }
+            event['end'] = event['start']
+        else:
+            event['end'] = {
+                'dateTime': datetime.combine(mail.startdate, mail.endtime),
+                'timeZone': local_zone
+            }
+
+        no_of_days = (mail.enddate - mail.startdate).days
+        event['recurrence'] = [
+            f'RRULE:FREQ=DAILY;COUNT={no_of_days}'  
+        ]
+    
+    return event
+
+def addEvent(creds, mail, conflict_resolution = 'ask_user', index = None, writer = None):
+
+    # with a writer the calendar changes are only queued, writer.flush() sends them.
+    # None when a calendar request failed, the conflict lookup of a lazily loaded index included
+
+    try:
+        if writer is not None:
+            service = writer.service
+        else:
+            service = getService("calendar", "v3", creds)
+        event_links = []
+
+        if mail.all_dates and len(mail.all_dates) > 1:
+
+            for date in mail.all_dates:
+
+                event = createEvent(mail, date)
+                event_links.append(insertEvent(service, event, conflict_resolution, index = index, writer = writer, mail = mail))
+        else:
+            event = createEvent(mail)
+            event_links.append(insertEvent(service, event, conflict_resolution, index = index, writer = writer, mail = mail))
+        
+        return event_links
+            
+    except (HttpError, httplib2.HttpLib2Error, OSError) as error:
+        print(f"An error occurred: {error}")
+        return None
+
+def wait(seconds, wake = None):
+    print(f'[o] Waiting for {seconds:.0f} seconds...')
+
+    # with an event the wait ends early once it is set
+    if wake is None:
+        sleep(seconds)
+    else:
+        wake.wait(seconds)
+
+def handleMail(creds, mail, auto, index = None, writer = None):
+
+    # show an extracted mail, fill in what is missing and add it to the calendar
+    # returns the links of the events that were added, with a writer the events
+    # are only queued and reportAdded reports them once the writer is flushed
+
+    ledger = getLedger() if mail.id else None
+
+    def skip():
+        if ledger:
+            ledger.record(mail.id, 'skipped')
+        return []
+
+    if not (mail.startdate or mail.starttime):
+        print(colored(f"[=] Skipped \"{mail.subject}\"", 'light_green'))
+        return skip()
+
+    print("-"*80)
+
+    for field in fields(mail):
+        value = getattr(mail, field.name)
+
+        if field.name == 'excerpt' or (field.name == 'body' and value is None):
+            continue
+
+        print("{}: {}".format(colored(field.name, 'cyan'), colored(value, 'yellow')))
+
+    # nothing after this point reads the text of the mail
+    mail.release()
+
+    if not auto:
+        if ask("Add to calendar? [Y/n]: ") == 'n':
+            return skip()
+    if mail.startdate is None:
+        if not auto:
+            mail.startdate = datetime.date(dtparse(ask("Enter start-date: "), mail.when))
+            mail.enddate   = datetime.date(dtparse(ask("Enter end-date: ")  , mail.when))
+        else:
+            return skip()
+
+        # Check and ask for starttime if None
+    if mail.starttime is None:
+        if auto:
+            print("Assuming a all day event")
+            starttime = '-1'
+        else:
+            print("Enter -1 for a all day event")
+            starttime = ask("Enter starttime: ")
+
+        if starttime == '-1':
+            pass
+        else:
+            mail.starttime = datetime.time(dtparse(starttime                , mail.when))
+            mail.endtime   = datetime.time(dtparse(ask("Enter end-time: "), mail.when))
+
+    if auto:
+        # Keep both events
+        conflict_resolution = '3'
+    else:
+        conflict_resolution = 'ask_user'
+
+    addedEvent = addEvent(creds, mail, conflict_resolution = conflict_resolution, index = index, writer = writer)
+
+    if writer is not None:
+        # left extracted in the ledger, so the next run resumes it. Whatever was queued
+        # for it is taken back, flushWriter would otherwise mark it done with half its events
+        if addedEvent is None:
+            writer.discard(mail)
+            print(colored(f"[!] Could not add \"{mail.subject}\", keeping it for the next run", 'light_red'))
+            return []
+
+        if ledger:
+            # nothing queued means the user kept the old events
+            queued = [event['id'] for kind, event, owner in writer.pending.values() if owner is mail]
+            # flushWriter marks it done once the queued events exist
+            ledger.record(mail.id, 'inserting' if queued else 'done', events = queued)
+        return []
+
+    return reportAdded(mail, addedEvent)
+
+def reportAdded(mail, links):
+
+    # links of the events actually created for mail, None means nothing was added
+
+    links = [link for link in links or [] if link]
+
+    if links:
+        getMetrics().count('events_added', len(links))
+        print(colored(f"[+] Added \"{mail.title}\" to your calendar!", 'light_green'))
+
+    return links
+
+def flushWriter(writer):
+
+    addedEvents = []
+
+    for mail, links, eventIds in writer.flush():
+        addedEvents.extend(reportAdded(mail, links))
+
+        if eventIds and mail.id:
+            getLedger().record(mail.id, 'done', events = eventIds)
+
+    return addedEvents
+
+def startStage(work, inbox, outbox, workers):
+
+    # run work(mail) on workers threads for everything put in inbox and pass the mail on to outbox.
+    # inbox ends with STOP, the last worker to see it passes it on so the next stage stops too
+
+    remaining = [workers]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            mail = inbox.get()
+
+            if mail is STOP:
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+
+                if last:
+                    outbox.put(STOP)
+                else:
+                    # leave it for the other workers of this stage
+                    inbox.put(STOP)
+                return
+
+            try:
+                work(mail)
+            except Exception as e:
+                print(colored(f"[!] Dropping \"{mail.subject}\": {e}", 'light_red'))
+                continue
+
+            outbox.put(mail)
+
+    threads = [threading.Thread(target = worker, daemon = True) for _ in range(workers)]
+
+    for thread in threads:
+        thread.start()
+
+    return threads
+
+def fetchStage(creds, maxResults, outbox, batchSize = GMAIL_BATCH_SIZE, incremental = False, path = HISTORY_FILE):
+
+    # producer for runPipeline, pushes mails one batch at a time. outbox is bounded
+    # so fetching waits whenever the later stages fall behind
+
+    try:
+        service = getService("gmail", "v1", creds)
+
+        if incremental:
+            ids, historyId = listNewMail(service, maxResults, path)
+        else:
+            results = service.users().messages().list(userId = "me", labelIds = ['INBOX'], maxResults = maxResults, q='is:unread newer_than:2d').execute()
+            ids = [message['id'] for message in results.get('messages', [])]
+
+        ids = pendingIds(ids)
+
+        for i in range(0, len(ids), batchSize):
+
+            mails, fetched = fetchMails(service, ids[i:i + batchSize], batchSize)
+
+            if not incremental and fetched:
+                markRead(service, fetched)
+
+            for mail in filterMails(mails):
+                outbox.put(mail)
+
+        if incremental:
+            saveHistoryId(historyId, path)
+
+    except HttpError as error:
+        print(f"An error occurred: {error}")
+
+    finally:
+        outbox.put(STOP)
+
+def extractStage(mail, auto = True):
+    with getMetrics().timer('extract'):
+        extractDateTime([mail])
+    getLedger().extracted(mail)
+    releaseBodies([mail], auto)
+
+def releaseBodies(mails, auto):
+    # after extraction only the excerpt is read, the whole body is kept just to show it
+    # when asking about a mail, and mails without a date are skipped before that
+    for mail in mails:
+        if auto or not (mail.startdate or mail.starttime):
+            mail.release()
+
+def enrichStage(mail):
+    with getMetrics().timer('enrich'):
+        enrichMail(mail)
+
+def runPipeline(creds, maxResults, auto, workers = PIPELINE_WORKERS, queueSize = PIPELINE_QUEUE_SIZE, batchSize = GMAIL_BATCH_SIZE, incremental = False):
+
+    # Streaming version of the getMail -> extractDateTime -> extractTitleLocation -> addEvent phases.
+    # Stages are connected with bounded queues, so mail N can be enriched while N+1 is parsed and N+2
+    # fetched, and no more than a few queues worth of mail is ever held in memory.
+    # Calendar insertion stays on this thread since it may prompt the user
+
+    fetched = queue.Queue(maxsize = queueSize)
+    extracted = queue.Queue(maxsize = queueSize)
+    enriched = queue.Queue(maxsize = queueSize)
+
+    threading.Thread(target = fetchStage, args = (creds, maxResults, fetched, batchSize, incremental), daemon = True).start()
+
+    startStage(lambda mail: extractStage(mail, auto), fetched, extracted, workers['extract'])
+    startStage(enrichStage, extracted, enriched, workers['enrich'])
+
+    # mails arrive one at a time, so the index loads windows as they are asked about
+    # and calendar writes go out whenever a batch worth of them is queued
+    service = getService("calendar", "v3", creds)
+    index = CalendarIndex(service)
+    writer = CalendarWriter(service, index)
+
+    addedEvents = []
+    count = 0
+
+    while True:
+        mail = enriched.get()
+
+        if mail is STOP:
+            break
+
+        count += 1
+
+        with getMetrics().timer('insert'):
+            handleMail(creds, mail, auto, index, writer)
+
+            if len(writer.pending) >= writer.batchSize:
+                addedEvents.extend(flushWriter(writer))
+
+    with getMetrics().timer('insert', 0):
+        addedEvents.extend(flushWriter(writer))
+
+    getRelevanceFilter().report()
+
+    if count == 0:
+        print("[!] No mails fit current criteria")
+    else:
+        printTitleCacheStats()
+
+    return count, addedEvents
+
+class NotificationHandler(BaseHTTPRequestHandler):
+    # accepts Pub/Sub push requests for Gmail watch notifications, whose message data is
+    # base64 encoded json like {"emailAddress": "...", "historyId": 1234}
+
+    def do_POST(self):
+        token = parse_qs(urlparse(self.path).query).get('token', [None])[0]
+
+        if self.server.token and token != self.server.token:
+            self.send_response(403)
+            self.end_headers()
+            return
+
+        try:
+            envelope = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            data = json.loads(base64.b64decode(envelope['message']['data']))
+            historyId = int(data['historyId'])
+        except Exception:
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        # anything at or before the saved checkpoint has already been synced
+        saved = loadHistoryId(self.server.path)
+
+        if saved is None or historyId > int(saved):
+            self.server.wake.set()
+
+        # pub/sub keeps redelivering until it gets a 2xx
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def isLoopback(host):
+    return host in ('localhost', '::1') or host.startswith('127.')
+
+def startReceiver(wake, port = PUSH_PORT, token = None, path = HISTORY_FILE, host = PUSH_HOST):
+
+    # local webhook for Gmail push notifications, sets wake whenever there is something new
+
+    if not (token or isLoopback(host)):
+        raise ValueError(f"refusing to serve push notifications on {host} without a push token")
+
+    server = ThreadingHTTPServer((host, port), NotificationHandler)
+    server.wake = wake
+    server.token = token
+    server.path = path
+
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+
+    print(f"[~] Listening for Gmail notifications on {host}:{server.server_address[1]}")
+
+    return server
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    # serves METRICS in the prometheus text format on /metrics
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        body = METRICS.prometheus().encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def startMetricsServer(port = METRICS_PORT, host = METRICS_HOST):
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+
+    print(f"[~] Serving metrics on {host}:{server.server_address[1]}")
+
+    return server
+
+def watchMailbox(creds, topic):
+
+    # ask gmail to publish inbox changes to the pub/sub topic, returns the watch expiration
+    # (epoch seconds). Watches last about a week, runDaemon's cycle renews them before that
+
+    service = getService("gmail", "v1", creds)
+    response = service.users().watch(userId = "me", body = {'topicName': topic, 'labelIds': ['INBOX']}).execute()
+
+    return int(response['expiration']) / 1000
+
+def processMails(creds, mails, auto, batched = False, workers = 1):
+
+    # filter -> extract -> enrich -> insert for mails that were already fetched
+
+    mails = filterMails(mails)
+    getRelevanceFilter().report()
+
+    if not mails:
+        return []
+
+    print("[~] Extracting date and time...")
+
+    with getMetrics().timer('extract', len(mails)):
+        if workers > 1:
+            extractDateTimeParallel(mails, workers)
+        else:
+            extractDateTime(mails)
+
+    for mail in mails:
+        getLedger().extracted(mail)
+
+    releaseBodies(mails, auto)
+
+    stats = dateCacheStats()
+    print(f"[~] Date cache: {stats['hits']} hits, {stats['misses']} misses ({stats['fast']} fast path, {stats['dateparser']} dateparser)")
+
+    print("[~] Generating titles and location...")
+
+    with getMetrics().timer('enrich', len(mails)):
+        extractTitleLocation(mails, batched = batched)
+
+    printTitleCacheStats()
+
+    # one events().list for the whole cycle, conflict checks then run against the index
+    # and every insert and delete of the cycle goes out in batches at the end
+    with getMetrics().timer('insert', len(mails)):
+        service = getService("calendar", "v3", creds)
+        index = CalendarIndex(service)
+        writer = CalendarWriter(service, index)
+        span = calendarSpan(mails)
+
+        if span:
+            index.load(*span)
+
+        for mail in mails:
+            handleMail(creds, mail, auto, index, writer)
+
+        return flushWriter(writer)
+
+def reportCycle(path = METRICS_FILE):
+
+    # print where the time of the last cycle went and append it to the metrics file
+
+    metrics = getMetrics()
+    summary = metrics.cycle()
+    metrics.count('cycles')
+
+    stages = ', '.join(f"{stage} {stats['seconds']:.2f}s" for stage, stats in summary['stages'].items())
+    requests = summary['counters'].get('api_requests', {})
+    calls = sum(requests.values())
+    retries = sum(summary['counters'].get('api_retries', {}).values())
+
+    print(f"[~] Cycle took {stages or 'no time'}, {calls} api requests, {retries} retries")
+
+    summary['time'] = datetime.now().astimezone().isoformat()
+    summary['account'] = getattr(ACCOUNT, 'name', None)
+
+    with open(path, 'a') as f:
+        f.write(json.dumps(summary) + '\n')
+
+    return summary
+
+def runCycle(creds, maxResults, auto, incremental = False, pipeline = False, batched = False, workers = 1):
+
+    # one fetch -> extract -> enrich -> insert pass, returns how many mails were fetched
+
+    try:
+        return cycleMails(creds, maxResults, auto, incremental, pipeline, batched, workers)
+    finally:
+        reportCycle()
+
+def cycleMails(creds, maxResults, auto, incremental = False, pipeline = False, batched = False, workers = 1):
+
+    if pipeline:
+        print("[o] Streaming mail through the pipeline...")
+        count, _ = runPipeline(creds, maxResults, auto, incremental = incremental)
+        return count
+
+    print("[o] Getting mail...")
+
+    if incremental:
+        mails = syncMail(creds, maxResults)
+    else:
+        mails = getMail(creds, maxResults)
+
+    if not mails or len(mails) == 0:
+        print("[!] No mails fit current criteria")
+        return 0
+    
+    print("[~] Pulled mail from Gmail API!")
+
+    processMails(creds, mails, auto, batched, workers)
+
+    return len(mails)
+
+def backfillQuery(query, after = None, before = None):
+    # gmail search with an optional YYYY/MM/DD window
+    if after:
+        query += f" after:{after}"
+    if before:
+        query += f" before:{before}"
+    return query.strip()
+
+def loadBackfill(query, path = BACKFILL_FILE):
+
+    # page token to resume from, None to start at the first page
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'r') as f:
+        checkpoint = json.load(f)
+
+    # a different query starts over
+    if checkpoint.get('query') != query:
+        return None
+
+    return checkpoint.get('pageToken')
+
+def saveBackfill(query, pageToken, path = BACKFILL_FILE):
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'query': query, 'pageToken': pageToken}, f)
+
+    os.replace(path + '.tmp', path)
+
+def backfill(creds, query, after = None, before = None, auto = True, batched = False, workers = 1, pageSize = BACKFILL_PAGE_SIZE, path = BACKFILL_FILE):
+
+    # Import every mail matching query, one page of messages().list at a time so memory stays
+    # bounded by the page size. The next page token is saved after each page is handled, an
+    # interrupted import picks up from there and the ledger skips whatever was already done.
+    # Read state is left alone
+
+    query = backfillQuery(query, after, before)
+    service = getService("gmail", "v1", creds)
+
+    pageToken = loadBackfill(query, path)
+
+    if pageToken:
+        print(f"[~] Resuming backfill of \"{query}\"")
+    else:
+        print(f"[o] Backfilling \"{query}\"")
+
+    pages = 0
+    total = 0
+
+    while True:
+        results = service.users().messages().list(userId = "me", q = query, maxResults = pageSize, pageToken = pageToken).execute()
+
+        ids = pendingIds([message['id'] for message in results.get('messages', [])], resume = pages == 0)
+        mails, _ = fetchMails(service, ids)
+
+        if mails:
+            processMails(creds, mails, auto, batched, workers)
+
+        pages += 1
+        total += len(mails)
+        pageToken = results.get('nextPageToken')
+
+        print(f"[~] Backfill page {pages} done, {total} mails so far")
+        reportCycle()
+
+        if not pageToken:
+            break
+
+        saveBackfill(query, pageToken, path)
+
+    # finished, a later run of the same query starts from the first page again
+    if os.path.exists(path):
+        os.remove(path)
+
+    print(colored(f"[~] Backfill finished, {total} mails imported", 'light_green'))
+
+    return total
+
+def nextInterval(interval, activity, minInterval, maxInterval):
+    # poll faster right after mail came in and back off while the inbox is quiet
+    if activity:
+        return max(minInterval, interval / 2)
+    return min(maxInterval, interval * 1.5)
+
+def runDaemon(cycle, interval, minInterval = DAEMON_MIN_INTERVAL, maxInterval = DAEMON_MAX_INTERVAL, jitter = DAEMON_JITTER, wake = None):
+
+    # Runs cycle() until SIGTERM/SIGINT. cycle returns how much mail it handled, which moves
+    # the polling interval between minInterval and maxInterval. Nothing is kept between
+    # cycles besides the caches, so memory stays flat however long this runs.
+    # Setting wake (see startReceiver) starts the next cycle right away
+
+    stop = threading.Event()
+    wake = wake or threading.Event()
+
+    def shutdown(signum, frame):
+        print(colored("[~] Shutting down after this cycle...", 'light_green'))
+        stop.set()
+        wake.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    minInterval = min(minInterval, interval)
+    maxInterval = max(maxInterval, interval)
+
+    while not stop.is_set():
+
+        try:
+            activity = cycle()
+        except Exception as e:
+            # one bad cycle should not take the daemon down
+            print(colored(f"[!] Cycle failed: {e}", 'light_red'))
+            activity = 0
+
+        if stop.is_set():
+            break
+
+        interval = nextInterval(interval, activity, minInterval, maxInterval)
+
+        # spread out the requests of clients started at the same time
+        wait(interval * random.uniform(1 - jitter, 1 + jitter), wake)
+        wake.clear()
+
+    print("[~] Stopped")
+
+class Account:
+    # one mailbox served by runAccounts, with its credentials and its state directory.
+    # Settings in ACCOUNTS_FILE: maxResults and interval, both optional
+
+    def __init__(self, name, settings = None, directory = ACCOUNTS_DIR):
+        settings = settings or {}
+
+        self.name = name
+        self.directory = os.path.join(directory, name)
+        self.token = os.path.join(self.directory, "token.json")
+        self.maxResults = settings.get('maxResults')
+        self.interval = settings.get('interval')
+
+        self.lock = threading.Lock()
+        self.creds = None
+        self.failures = 0
+        self.metrics = Metrics(METRICS, account = name)
+
+    def credentials(self):
+        from google.oauth2.credentials import Credentials
+
+        with self.lock:
+            if self.creds is None:
+                self.creds = Credentials.from_authorized_user_file(self.token, SCOPES)
+
+        self.refresh()
+
+        return self.creds
+
+    def refresh(self, before = 0):
+
+        # refresh when the token expires within before seconds and write it back to disk.
+        # Cached api clients hold the same creds object, so they pick up the new token
+
+        with self.lock:
+            creds = self.creds
+
+            if creds is None or not creds.refresh_token:
+                return False
+
+            # google-auth keeps expiry as naive utc
+            now = datetime.now(timezone.utc).replace(tzinfo = None)
+
+            if creds.valid and creds.expiry and creds.expiry - now > timedelta(seconds = before):
+                return False
+
+            from google.auth.transport.requests import Request
+
+            creds.refresh(Request())
+            saveToken(creds, self.token)
+
+        return True
 
-    today = context_time.date()
+def loadAccounts(path = ACCOUNTS_FILE, directory = ACCOUNTS_DIR):
+    # ACCOUNTS_FILE is {"name": {settings}}
+    with open(path, 'r') as f:
+        return [Account(name, settings, directory) for name, settings in json.load(f).items()]
 
-    if result['startdate'] and not result['enddate']:
-        result['enddate'] = result['startdate']
-    
-    # If only enddate use today as startdate
-    if not result['startdate'] and result['enddate']:
-        result['startdate'] = today
-    
-    # If dates are in wrong order, swap them
-    if result['startdate'] and result['enddate'] and result['startdate'] > result['enddate']:
-        result['startdate'], result['enddate'] = result['enddate'], result['startdate']
-    
-    # Not sure about this
-    # If only one time is found early in the day, assume starttime
-    # and add a default duration (e.g., 1 hour)
-    if result['starttime'] and not result['endtime']:
-        hour = result['starttime'].hour
-        minute = result['starttime'].minute
-        # If time is before 1pm, assume it's a start time and add 1 hour
-        if hour < 13:
-            result['endtime'] = time((hour + 1) % 24, minute)
+def addAccount(name, secrets = "credentials.json", path = ACCOUNTS_FILE, directory = ACCOUNTS_DIR):
 
-    # If times are in wrong order, swap them
-    if result['starttime'] and result['endtime']:
-        start_minutes = result['starttime'].hour * 60 + result['starttime'].minute
-        end_minutes = result['endtime'].hour * 60 + result['endtime'].minute
-        
-        # Only swap if end is earlier and not likely a next-day event
-        if end_minutes < start_minutes and (start_minutes - end_minutes) < 720:
-            result['starttime'], result['endtime'] = result['endtime'], result['starttime']
-    
-    if result['starttime'] and not result['endtime']:
-        result['endtime'] = result['starttime']
-            
-    return None
-def extractDateTime(mails):
-    for mail in mails:
-        body = mail.get('body', '').lower()
-        subject = mail.get('subject', '').lower()
-        context_time = mail.get('when', datetime.now())
+    # sign in to one more mailbox and add it to the registry
 
-        full_text = f"{subject} {body}".lower()
+    account = Account(name, directory = directory)
+    os.makedirs(account.directory, exist_ok = True)
 
-        datetime_info = {
-            'startdate': None,
-            'enddate': None,
-            'starttime': None,
-            'endtime': None,
-            'daily': None
-        }
+    authenticate(account.token, secrets)
 
-        date_range = parseDateRange(full_text, context_time)
+    registry = {}
 
-        if date_range:
-            datetime_info['startdate'] = date_range[0]
-            datetime_info['enddate'] = date_range[1]
-            datetime_info['daily'] = True
-        else:
-            # Try to parse connected dates (with &, and, or commas)
-            connected_dates = parseConnectedDates(full_text, context_time)
-            
-            if connected_dates:
-                datetime_info['startdate'] = connected_dates[0]
-                datetime_info['enddate'] = connected_dates[-1]
-                # If we have multiple specific dates, they might not be daily events
-                datetime_info['daily'] = False
-                # Store all dates for multi-day handling later
-                datetime_info['all_dates'] = connected_dates
-            else:
-                # Try to find individual dates
-                dates = parseExplicitDate(full_text, context_time)
-                
-                if not dates:
-                    # Try relative dates
-                    dates = parseRelativeDates(full_text, context_time)
-                
-                if dates:
-                    dates.sort()
-                    datetime_info['startdate'] = dates[0]
-                    datetime_info['enddate'] = dates[-1]
-        
-        times = parseTime(full_text)
-        if times:
-            times.sort()
-            datetime_info['starttime'] = times[0]
-            datetime_info['endtime'] = times[-1] if len(times) > 1 else None
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            registry = json.load(f)
 
-        fixDateTime(datetime_info, context_time)
+    registry.setdefault(name, {})
 
-        for key, value in datetime_info.items():
-            mail[key] = value
+    with open(path + '.tmp', 'w') as f:
+        json.dump(registry, f, indent = 2)
 
-def extractLocation(text):
+    os.replace(path + '.tmp', path)
 
-    location_regex = r'\b(?:in|venue:?|at|location:?|where:?)(?:\s+the)?\s+([\w\s,()\-]+?)(?=\r|\n|$|-|\.)'
+    print(colored(f"[~] Added account \"{name}\"", 'light_green'))
 
-    results = re.findall(location_regex, text)
+    return account
 
-    if results:
-        longest_match = sorted(results, key=len)[-1]
-        return longest_match.strip()
+def refreshTokens(accounts, stop, before = TOKEN_REFRESH_BEFORE, every = TOKEN_CHECK_INTERVAL):
 
-    else:
-        return ''
+    # background thread of runAccounts, keeps every token fresh ahead of its cycles
 
-def generateTitleLocation(mail):
+    while not stop.wait(every):
+        for account in accounts:
+            try:
+                if account.refresh(before):
+                    METRICS.count('token_refreshes', account = account.name)
+            except Exception as e:
+                METRICS.count('token_refresh_failures', account = account.name)
+                print(colored(f"[!] Could not refresh the token of {account.name}: {e}", 'light_red'))
 
-    if os.path.exists("gemini-api.key"):
-        with open("gemini-api.key", 'r') as f:
-            api_key = f.read()
-    else:
-        return None
+def accountCycle(account, maxResults, auto, incremental, batched, workers):
 
-    client = genai.Client(
-        api_key = api_key
-    )
+    # runCycle for one account, with its state files and credentials
 
-    model = "gemini-2.0-flash-lite"
-    contents = [
-        types.Content(
-            role="user",
-            parts=[
-                types.Part.from_text(text=f"""Extract event details from the following text. Your task is to:
-                                                Generate the event title (Be as specific as possible).
-                                                Determine the event location.
+    ACCOUNT.name = account.name
+    ACCOUNT.directory = account.directory
+    ACCOUNT.metrics = account.metrics
 
-                                                Respond with only one line in the following format:
+    try:
+        os.makedirs(account.directory, exist_ok = True)
+        return runCycle(account.credentials(), account.maxResults or maxResults, auto, incremental, False, batched, workers)
+    finally:
+        ACCOUNT.name = ACCOUNT.directory = ACCOUNT.metrics = None
 
-                                                [title]|[location]
+def runAccounts(accounts, interval, maxResults, auto = True, incremental = True, batched = False, workers = 1, poolSize = ACCOUNT_WORKERS, minInterval = DAEMON_MIN_INTERVAL, maxInterval = DAEMON_MAX_INTERVAL, jitter = DAEMON_JITTER):
 
-                                                Where:
-                                                    [title]: The event's name from the text.
-                                                    [location]: The location where the event takes place.
+    # Multi account version of runDaemon. Accounts wait in a queue ordered by when their next
+    # cycle is due and up to poolSize cycles run at once on a shared pool, each account at most
+    # once, so a busy mailbox can't keep the others waiting for a worker. An account whose cycle
+    # fails backs off on its own and the rest carry on. Cycles can't prompt, so this is always auto
 
-                                                {mail}
-                                            """),
-            ],
-        ),
-    ]
-    generate_content_config = types.GenerateContentConfig(
-        temperature=0.5,
-        top_p=0.95,
-        top_k=40,
-        max_output_tokens=8192,
-        response_mime_type="text/plain",
-    )
+    stop = threading.Event()
+    wake = threading.Event()
 
-    title = ""
+    def shutdown(signum, frame):
+        print(colored("[~] Shutting down after the running cycles...", 'light_green'))
+        stop.set()
+        wake.set()
 
-    for chunk in client.models.generate_content_stream(
-        model=model,
-        contents=contents,
-        config=generate_content_config,
-        ):
-        
-        title += chunk.text
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
 
-    return title.strip()
+    threading.Thread(target = refreshTokens, args = (accounts, stop), daemon = True).start()
 
-def extractTitleLocation(mails):
-    for mail in tqdm(mails):
+    # (due, order, account), order keeps accounts due at the same time round robin
+    due = [(0, i, account) for i, account in enumerate(accounts)]
+    intervals = {account.name: account.interval or interval for account in accounts}
+    running = dict()
+    order = len(accounts)
 
-        if not (mail['startdate'] or mail['starttime']):
-            continue
+    def bounds(account):
+        base = account.interval or interval
+        return min(minInterval, base), max(maxInterval, base)
 
-        try:
-            mail['title'], mail['location'] = generateTitleLocation(mail['body']).split('|')
-        except:
-            print(colored(f"[!] Could not generate title and location for {mail['subject']}", 'light_red'))
-            mail['title'] = mail['subject']
-            mail['location'] = extractLocation(mail['body'])
+    print(f"[o] Serving {len(accounts)} accounts")
 
-def insertEvent(service, event, conflict_resolution = 'ask_user', tz = datetime.now().astimezone().tzinfo):
+    with ThreadPoolExecutor(max_workers = poolSize) as executor:
 
-    if event['start'].get('dateTime')   :
-        events_result = service.events().list(
-                        calendarId='primary',
-                        timeMin=event['start']['dateTime'].astimezone(tz).isoformat(),
-                        timeMax=event['end']['dateTime'].astimezone(tz).isoformat(),
-                        singleEvents=True,
-                        orderBy='startTime'
-                    ).execute()
-    elif event['start'].get('date'):
-        events_result = service.events().list(
-                        calendarId='primary',
-                        timeMin=datetime.combine(event['start']['date'], time.min).astimezone(tz).isoformat(),
-                        timeMax=datetime.combine(event['end']['date'], time.max).astimezone(tz).isoformat(),
-                        singleEvents=True,
-                        orderBy='startTime'
-                    ).execute()
+        while not stop.is_set():
 
-    conflicts = events_result.get('items', [])
+            # cleared before looking at the cycles, a cycle finishing after this still wakes the wait below
+            wake.clear()
+            now = monotonic()
 
-    if conflicts:
-        print(colored("[!] Conflicting events found:", 'light_red'))
+            while due and due[0][0] <= now and len(running) < poolSize:
+                _, _, account = heapq.heappop(due)
+                future = executor.submit(accountCycle, account, maxResults, auto, incremental, batched, workers)
+                future.add_done_callback(lambda _: wake.set())
+                running[future] = account
 
-        for conflict in conflicts:
-            
-            summary = conflict.get('summary', 'No Title')
-            start = conflict['start']
-            end = conflict['end']
+            for future in [future for future in running if future.done()]:
+                account = running.pop(future)
+                name = account.name
 
-            print(f"- {summary}: starts at {start} and ends at {end}")
+                try:
+                    activity = future.result()
+                    account.failures = 0
+                    delay = intervals[name] = nextInterval(intervals[name], activity, *bounds(account))
+                except Exception as e:
+                    account.failures += 1
+                    METRICS.count('account_failures', account = name)
+                    print(colored(f"[!] Cycle of {name} failed: {e}", 'light_red'))
+                    delay = min(bounds(account)[1], intervals[name] * 2 ** account.failures)
 
-        while True:
+                order += 1
+                heapq.heappush(due, (monotonic() + delay * random.uniform(1 - jitter, 1 + jitter), order, account))
 
-            if conflict_resolution == "1":
-                print(colored("[=] Keeping old events. New event will not be added.", 'light_green'))
-                return None
-            
-            elif conflict_resolution == "2":
-                # Delete conflicting events.
-                for conflict in conflicts:
-                    event_id = conflict.get('id')
-                    service.events().delete(calendarId='primary', eventId=event_id).execute()
-                        
-                print(colored("[-] Old conflicting events deleted. Proceeding to add new event.", 'light_green'))
-                break
-            
-            elif conflict_resolution == "3":
-                print(colored("[+] Adding new event alongside existing conflicting events.", 'light_green'))
+            if stop.is_set():
                 break
-            
-            else:
-                conflict_resolution = input("1: Keep old\n2: Keep new\n3: Keep both\nOption: ").strip()
-    
-    if event['start'].get('dateTime'):
-        try:
-            event['start']['dateTime'] = event['start']['dateTime'].isoformat()
-            event['end']['dateTime'] = event['end']['dateTime'].isoformat()
-        except:
-            event['start']['dateTime'] = event['start']['dateTime']
-            event['end']['dateTime'] = event['end']['dateTime']
-    else:
-        try:
-            event['start']['date'] = event['start']['date'].isoformat()
-            event['end']['date'] = event['end']['date'].isoformat()
-        except:
-            # SOMETIMES THESE DECIDE TO IDENTIFY AS A STRING... I DO NOT KNOW WHY!!!!!!!!!!!!
-            event['start']['date'] = event['start']['date']
-            event['start']['date'] = event['start']['date']
 
-    event = service.events().insert(calendarId='primary', body=event).execute()
+            # sleep until the next account is due or a running cycle finishes
+            wake.wait(max(0, due[0][0] - monotonic()) if due and len(running) < poolSize else None)
 
-    return event.get("htmlLink")
+    print("[~] Stopped")
 
-def createEvent(mail, date = None, local_zone = 'Asia/Kolkata'):
+def startupProfile():
 
-    event = {
-        'summary': mail['title'],
-        'description': mail['subject'],
-        'location': mail['location']
-    }
+    # how long main.py took to import and what each lazily imported dependency adds once a
+    # stage needs it. Dependencies share modules, so each one is only charged for what the
+    # ones before it didn't already load
 
-    if date is not None:
-        event['start'] = {}
-        event['end'] = {}
+    print(f"[~] {'main.py':<32} {IMPORT_TIME * 1000:8.1f} ms")
 
-        if mail['starttime'] is None:
-            event['start']['date'] = date
-            event['start']['timeZone'] = local_zone
-            event['end']['date'] = date
-            event['end']['timeZone'] = local_zone
+    total = IMPORT_TIME
 
-        else:
-            event['start']['dateTime'] = datetime.combine(date, event['starttime'])
-            event['end']['date']       = datetime.combine(date, event['endtime'])
-            event['start']['timeZone'] = local_zone
-            event['end']['timeZone'] = local_zone
+    for name in LAZY_IMPORTS:
+        start = perf_counter()
+        importlib.import_module(name)
+        elapsed = perf_counter() - start
+        total += elapsed
 
-    else:
-        if mail['starttime'] is None:
-            event['start'] = {
-                'date': mail['startdate'],
-                'timeZone': local_zone
-            }
-            event['end'] = {
-                'date': mail['enddate'],
-                'timeZone': local_zone
-            }
-        else:
-            event['start'] = {
-                'dateTime': datetime.combine(mail['startdate'], mail['starttime']),
-                'timeZone': local_zone
-            }
-            event['end'] = {
-                'dateTime': datetime.combine(mail['enddate'], mail['endtime']),
-                'timeZone': local_zone
-            }
+        print(f"[~] {name:<32} {elapsed * 1000:8.1f} ms")
 
-    # when creating an event for a date range,
-    # we dont want the event to span from say Saturday 8 am to Sunday 10am
-    # we want it from Saturday 8am to 10am and then Sunday again from 8am to 10am
-    # this is where the recurrence flag comes in
+    print(f"[~] {'total':<32} {total * 1000:8.1f} ms")
 
-    if mail['daily']:
-        if mail['starttime'] is None:
-            event['start'] = {
-                'date': mail['startdate'],
-                'timeZone': local_zone
-            }
-            event['end'] = event['start']
-        else:
-            event['end'] = {
-                'dateTime': datetime.combine(mail['startdate'], mail['endtime']),
-                'timeZone': local_zone
-            }
+def argValue(flag, default = None):
+    # value following flag on the command line
+    if flag in sys.argv[:-1]:
+        return sys.argv[sys.argv.index(flag) + 1]
+    return default
 
-        no_of_days = (mail['enddate'] - mail['startdate']).days
-        event['recurrence'] = [
-            f'RRULE:FREQ=DAILY;COUNT={no_of_days}'  
-        ]
-    
-    return event
+def parseArgs(argv = None):
 
-def addEvent(creds, mail, conflict_resolution = 'ask_user'):
+    # main.py [maxResults] [--auto] [seconds] [options], the positional arguments are all optional
+    # and may be mixed with the options, so "main.py --accounts" and "main.py 50 -a 300 -p" both work
 
-    try:
-        service = build("calendar", "v3", credentials = creds)
-        event_links = []
+    import argparse
 
-        if mail.get('all_dates') and len(mail.get('all_dates', [])) > 1:
+    parser = argparse.ArgumentParser(prog = "main.py", description = "Adds the events in your gmail to google calendar")
 
-            for date in mail['all_dates']:
+    parser.add_argument('maxResults', nargs = '?', type = int, default = 5, help = "mails to look at per cycle")
+    parser.add_argument('interval', nargs = '?', type = int, default = 600, help = "seconds between cycles with --auto")
 
-                event = createEvent(mail, date)
-                event_links.append(insertEvent(service, event, conflict_resolution))
-        else:
-            event = createEvent(mail)
-            event_links.append(insertEvent(service, event, conflict_resolution))
-        
-        return event_links
-            
-    except HttpError as error:
-        print(f"An error occurred: {error}")
+    parser.add_argument('-a', '--auto', action = 'store_true', help = "run as a daemon without asking anything")
+    parser.add_argument('-i', '--incremental', action = 'store_true', help = "only mail that arrived since the last cycle")
+    parser.add_argument('-p', '--pipeline', action = 'store_true', help = "stream mails through the stages")
+    parser.add_argument('-b', '--batched', action = 'store_true', help = "several mails per gemini request")
+    parser.add_argument('--workers', type = int, default = 1, help = "processes for date extraction")
+    parser.add_argument('--no-filter', dest = 'filter', action = 'store_false', help = "parse every mail, not just the ones that look like events")
+
+    # --push projects/<project>/topics/<topic> syncs as soon as gmail reports a change,
+    # polling keeps running as a fallback. Notifications only carry a historyId so this is incremental
+    parser.add_argument('--push', metavar = 'TOPIC', help = "pub/sub topic for gmail push notifications")
+    parser.add_argument('--port', type = int, default = PUSH_PORT, help = "port of the push receiver")
+    parser.add_argument('--push-host', default = PUSH_HOST, help = "address of the push receiver, anything but loopback needs --push-token")
+    parser.add_argument('--push-token', help = "token pub/sub has to send with every push")
+
+    parser.add_argument('--backfill', metavar = 'QUERY', help = "process everything matching a gmail query, then exit")
+    parser.add_argument('--after', help = "backfill only mail after this date")
+    parser.add_argument('--before', help = "backfill only mail before this date")
+
+    parser.add_argument('--accounts', action = 'store_true', help = "serve every account in %s" % ACCOUNTS_FILE)
+    parser.add_argument('--add-account', metavar = 'NAME', help = "sign in to another mailbox for --accounts")
+    parser.add_argument('--account-workers', type = int, default = ACCOUNT_WORKERS, help = "accounts synced at once")
+
+    parser.add_argument('--metrics-port', type = int, default = METRICS_PORT, help = "port of the prometheus endpoint, 0 picks one")
+    parser.add_argument('--metrics-host', default = METRICS_HOST, help = "address of the prometheus endpoint")
+
+    # --endpoint http://host:port talks to a fake google (benchmarks/fakeserver.py) instead
+    parser.add_argument('--endpoint', default = API_ENDPOINT, help = "send every api request to this url instead of google")
+    parser.add_argument('--endpoint-auth', action = 'store_true', help = "sign in as usual and send the credentials to --endpoint, for fakeserver.py --record")
+    parser.add_argument('--startup-profile', action = 'store_true', help = "print import times and exit")
+
+    args = parser.parse_intermixed_args(argv)
 
-def wait(seconds):
-    print(f'[o] Waiting for {seconds} seconds...')
-    sleep(seconds)
+    if not (args.push_token or isLoopback(args.push_host)):
+        parser.error("--push-host other than loopback needs --push-token")
+
+    return args
 
 def main():
-    
-    maxResults = sys.argv[1] if len(sys.argv) > 1 else 5
-    auto = (sys.argv[2] == '--auto' or sys.argv[2] == '-a') if len(sys.argv) > 2 else False
-    sec = sys.argv[3] if len(sys.argv) > 3 else 600 # every 10 minutes
 
-    creds = authenticate()
+    global API_ENDPOINT, API_ENDPOINT_AUTH, RELEVANCE_FILTER
 
-    if creds and creds.valid:
+    args = parseArgs()
 
-        print("[~] User authenticated!")
-        print("[o] Getting mail...")
+    if args.startup_profile:
+        startupProfile()
+        return
 
-        mails = getMail(creds, maxResults)
+    # only for someone watching, not cron, systemd or a redirected log
+    if sys.stdout.isatty():
+        print(BANNER)
 
-        if not mails or len(mails) == 0:
-            print("[!] No mails fit current criteria")
-            if auto:
-                wait(sec)
-                main()
-        
-        print("[~] Pulled mail from Gmail API!")
+    API_ENDPOINT = args.endpoint
+    API_ENDPOINT_AUTH = args.endpoint_auth
+    RELEVANCE_FILTER = args.filter
 
-        print("[~] Extracting date and time...")
-        extractDateTime(mails)
+    if args.add_account:
+        addAccount(args.add_account)
+        return
 
-        print("[~] Generating titles and location...")
-        extractTitleLocation(mails)
+    maxResults = args.maxResults
+    auto = args.auto
+    sec = args.interval
+    incremental = args.incremental
+    pipeline = args.pipeline
+    batched = args.batched
+    workers = args.workers
+    topic = args.push
 
-        addedEvents = []
-        for mail in mails:
+    if topic:
+        auto = True
+        incremental = True
 
-            if mail['startdate'] or mail['starttime']:
+    # there is nobody to ask in accounts mode or about a whole backlog
+    if args.accounts:
+        accounts = loadAccounts() if os.path.exists(ACCOUNTS_FILE) else []
 
-                print("-"*80)
+        # with nothing to schedule runAccounts would wait forever
+        if not accounts:
+            sys.exit(f"[!] No accounts in {ACCOUNTS_FILE}, add one with --add-account NAME")
 
-                for key, value in mail.items():
-                    print("{}: {}".format(colored(key, 'cyan'), colored(value, 'yellow')))
+        startMetricsServer(args.metrics_port, args.metrics_host)
+        runAccounts(accounts, sec, maxResults, True, True, batched, workers, args.account_workers)
+        return
 
-                if not auto:
-                    if input("Add to calendar? [Y/n]: ") == 'n':
-                        continue
-                if mail["startdate"] is None:
-                    if not auto:
-                        mail["startdate"] = datetime.date(dtparse(input("Enter start-date: "), mail['when']))
-                        mail['enddate']   = datetime.date(dtparse(input("Enter end-date: ")  , mail['when']))
-                    else:
-                        continue
+    creds = AnonymousCredentials() if API_ENDPOINT and not API_ENDPOINT_AUTH else authenticate()
 
-                    # Check and ask for starttime if None
-                if mail["starttime"] is None:
-                    if auto:
-                        print("Assuming a all day event")
-                        starttime = '-1'
-                    else:
-                        print("Enter -1 for a all day event")
-                        starttime = input("Enter starttime: ")
-
-                    if starttime == '-1':
-                        pass
-                    else:
-                        mail["starttime"] = datetime.time(dtparse(starttime                , mail['when']))
-                        mail['endtime']   = datetime.time(dtparse(input("Enter end-time: "), mail['when']))
-
-                if auto:
-                    # Keep both events
-                    conflict_resolution = '3'
-                else:
-                    conflict_resolution = 'ask_user'
+    if not (creds and creds.valid):
+        return
 
-                addedEvent = addEvent(creds, mail, conflict_resolution = conflict_resolution)
+    print("[~] User authenticated!")
 
-                addedEvents.extend(addedEvent)
-                
-                if addedEvent:
-                    print(colored(f"[+] Added \"{mail['title']}\" to your calendar!", 'light_green'))
-            else:
-                print(colored(f"[=] Skipped \"{mail['subject']}\"", 'light_green'))
-    
-        if auto:
-            wait(sec)
-            main()
+    if args.backfill:
+        backfill(creds, args.backfill, args.after, args.before, True, batched, workers)
+        return
+
+    if not auto:
+        runCycle(creds, maxResults, auto, incremental, pipeline, batched, workers)
+        return
+
+    wake = threading.Event()
+    watch = {'expiration': 0}
+
+    if topic:
+        startReceiver(wake, args.port, args.push_token, host = args.push_host)
+
+    startMetricsServer(args.metrics_port, args.metrics_host)
+
+    def cycle():
+        # creds are refreshed in place, the cached api clients keep using the same object
+        if creds.expired and creds.refresh_token:
+            from google.auth.transport.requests import Request
+
+            creds.refresh(Request())
+            saveToken(creds)
+
+        if topic and watch['expiration'] - time_now() < WATCH_RENEW_BEFORE:
+            watch['expiration'] = watchMailbox(creds, topic)
+
+        return runCycle(creds, maxResults, auto, incremental, pipeline, batched, workers)
+
+    runDaemon(cycle, sec, wake = wake)
+
+IMPORT_TIME = perf_counter() - IMPORT_STARTED
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
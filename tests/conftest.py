@@ -0,0 +1,19 @@
+import os.path
+import sys
+
+import pytest
+
+# main.py lives at the top of the repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main as cleo
+
+@pytest.fixture(autouse = True)
+def workdir(tmp_path, monkeypatch):
+    # state files (ledger, title cache, history) end up in a fresh directory for every test
+    monkeypatch.chdir(tmp_path)
+    cleo.getTitleCache.cache_clear()
+    cleo.openLedger.cache_clear()
+    yield tmp_path
+    cleo.getTitleCache.cache_clear()
+    cleo.openLedger.cache_clear()
@@ -0,0 +1,90 @@
+# CalendarWriter and CalendarIndex against a stub of the calendar service
+
+from datetime import date, datetime, time, timedelta, timezone
+
+import httplib2
+
+import main as cleo
+
+TZ = timezone(timedelta(hours = 5, minutes = 30))
+
+class Request:
+    def __init__(self, kind, body):
+        self.kind = kind
+        self.body = body
+
+class Batch:
+
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request, request_id))
+
+    def execute(self):
+        if self.service.outages:
+            self.service.outages -= 1
+            raise httplib2.HttpLib2Error("connection reset")
+
+        for request, request_id in self.requests:
+            self.service.created.append(request.body['id'])
+            self.callback(request_id, {'htmlLink': f"link/{request.body['id']}"}, None)
+
+class StubCalendar:
+
+    def __init__(self, outages = 0):
+        self.outages = outages
+        self.created = []
+
+    def new_batch_http_request(self, callback):
+        return Batch(self, callback)
+
+    def events(self):
+        return self
+
+    def insert(self, calendarId, body):
+        return Request('insert', body)
+
+def makeEvent(summary, day, hour):
+    return {
+        'summary': summary,
+        'start': {'dateTime': datetime.combine(day, time(hour), TZ).isoformat()},
+        'end': {'dateTime': datetime.combine(day, time(hour + 1), TZ).isoformat()}
+    }
+
+def test_failed_batches_stay_queued(monkeypatch):
+    monkeypatch.setattr(cleo, 'sleep', lambda seconds: None)
+    service = StubCalendar(outages = 2)
+    writer = cleo.CalendarWriter(service, retries = 1)
+    mail = cleo.Mail('m1')
+
+    writer.insert(makeEvent("Seminar", date(2025, 3, 12), 15), mail)
+
+    # both attempts hit the outage, nothing is lost
+    results = writer.flush()
+    assert results == [(mail, [], [])]
+    assert len(writer.pending) == 1
+
+    results = writer.flush()
+    assert len(results[0][2]) == 1 and results[0][1][0].startswith("link/")
+    assert service.created == results[0][2]
+    assert not writer.pending
+
+def test_daily_recurrence_is_indexed_per_day():
+    index = cleo.CalendarIndex(None, tz = TZ)
+    index.lo, index.hi = datetime(2025, 1, 1, tzinfo = TZ), datetime(2026, 1, 1, tzinfo = TZ)
+
+    event = makeEvent("Workshop", date(2025, 3, 14), 10)
+    event['id'] = 'workshop'
+    event['recurrence'] = ['RRULE:FREQ=DAILY;COUNT=3']
+    index.add(event)
+
+    def conflicts(day):
+        return index.conflicts(datetime.combine(day, time(10, 30), TZ), datetime.combine(day, time(11, 30), TZ))
+
+    assert [len(conflicts(date(2025, 3, day))) for day in (13, 14, 15, 16, 17)] == [0, 1, 1, 1, 0]
+
+    index.remove(event)
+    assert not index.events and not conflicts(date(2025, 3, 15))
@@ -0,0 +1,37 @@
+import pytest
+
+import main as cleo
+
+def test_defaults():
+    args = cleo.parseArgs([])
+    assert (args.maxResults, args.interval, args.auto) == (5, 600, False)
+
+@pytest.mark.parametrize('argv', [['--accounts'], ['--backfill', 'from:school'], ['--push', 'projects/p/topics/t']])
+def test_flags_without_max_results(argv):
+    assert cleo.parseArgs(argv).maxResults == 5
+
+def test_positionals_mixed_with_options():
+    args = cleo.parseArgs(['50', '-a', '300', '-p', '--workers', '4'])
+    assert (args.maxResults, args.auto, args.interval, args.pipeline, args.workers) == (50, True, 300, True, 4)
+
+def test_backfill_never_prompts(monkeypatch):
+    calls = []
+    monkeypatch.setattr(cleo, 'authenticate', lambda: type('Creds', (), {'valid': True})())
+    monkeypatch.setattr(cleo, 'backfill', lambda *args: calls.append(args))
+    monkeypatch.setattr('sys.argv', ['main.py', '5', '--backfill', 'q'])
+
+    cleo.main()
+
+    # auto, the fifth argument, is on even though --auto was not given
+    assert calls and calls[0][4] is True
+
+def test_accounts_without_accounts_exits(monkeypatch):
+    monkeypatch.setattr('sys.argv', ['main.py', '--accounts'])
+
+    with open(cleo.ACCOUNTS_FILE, 'w') as f:
+        f.write('{}')
+
+    with pytest.raises(SystemExit) as exit:
+        cleo.main()
+
+    assert 'No accounts' in str(exit.value.code)
@@ -0,0 +1,162 @@
+# Gemini enrichment against a local stub of the genai client, nothing here talks to the network
+
+import json
+import re
+import threading
+import time
+from datetime import date
+
+import pytest
+
+import main as cleo
+
+class StubError(Exception):
+    def __init__(self, code):
+        super().__init__(f"stub error {code}")
+        self.code = code
+
+class Chunk:
+    def __init__(self, text):
+        self.text = text
+
+class StubModels:
+
+    def __init__(self, failures = (), delay = 0.0):
+        self.failures = list(failures)
+        self.delay = delay
+        self.calls = 0
+        self.inFlight = 0
+        self.maxInFlight = 0
+        self.lock = threading.Lock()
+
+    def enter(self):
+        with self.lock:
+            self.calls += 1
+            self.inFlight += 1
+            self.maxInFlight = max(self.maxInFlight, self.inFlight)
+            failure = self.failures.pop(0) if self.failures else None
+
+        try:
+            time.sleep(self.delay)
+            if failure:
+                raise StubError(failure)
+        finally:
+            with self.lock:
+                self.inFlight -= 1
+
+    @staticmethod
+    def prompt(contents):
+        return contents[0].parts[0].text
+
+    def generate_content_stream(self, model, contents, config):
+        self.enter()
+        number = re.search(r'mail (\d+)', self.prompt(contents)).group(1)
+        # the answer arrives in pieces like a real stream
+        return [Chunk(f"Title {number}"), Chunk(f"|Room {number}")]
+
+    def generate_content(self, model, contents, config):
+        self.enter()
+        emails = re.findall(r'<email id="([^"]+)">\nmail (\d+)', self.prompt(contents))
+        return Chunk(json.dumps({mail_id: {'title': f"Title {number}", 'location': f"Room {number}"} for mail_id, number in emails}))
+
+class StubClient:
+    def __init__(self, **kwargs):
+        self.models = StubModels(**kwargs)
+
+@pytest.fixture(autouse = True)
+def noWaiting(monkeypatch):
+    # no backoff or rate limiter sleeps, the delays asked for are kept to check them
+    slept = []
+    monkeypatch.setattr(cleo, 'sleep', slept.append)
+    monkeypatch.setattr(cleo.GEMINI_LIMITER, 'capacity', 1000)
+    monkeypatch.setattr(cleo.GEMINI_LIMITER, 'tokens', 1000)
+    return slept
+
+def makeMails(count):
+    mails = []
+
+    for i in range(count):
+        text = f"mail {i} is a workshop on 12 march 2025 at 3pm"
+        mails.append(cleo.Mail(f"id{i}", subject = f"Workshop {i}", body = text, excerpt = text, startdate = date(2025, 3, 12)))
+
+    return mails
+
+def test_enriches_every_mail_concurrently():
+    client = StubClient(delay = 0.05)
+    mails = makeMails(8)
+
+    cleo.extractTitleLocation(mails, client, maxInFlight = 4)
+
+    assert [(mail.title, mail.location) for mail in mails] == [(f"Title {i}", f"Room {i}") for i in range(8)]
+    assert 1 < client.models.maxInFlight <= 4
+
+def test_undated_mails_are_not_sent():
+    client = StubClient()
+    mails = makeMails(2)
+    mails[1].startdate = None
+
+    cleo.extractTitleLocation(mails, client)
+
+    assert client.models.calls == 1
+    assert mails[1].title is None
+
+def test_retries_rate_limits_and_server_errors(noWaiting):
+    client = StubClient(failures = [429, 503])
+    mail = makeMails(1)[0]
+
+    cleo.enrichMail(mail, client)
+
+    assert (mail.title, mail.location) == ("Title 0", "Room 0")
+    assert client.models.calls == 3
+    # exponential backoff, the second wait is at least twice the base of the first
+    assert len(noWaiting) == 2 and noWaiting[1] >= 2 * cleo.GEMINI_BACKOFF
+
+def test_client_errors_fall_back_to_the_regex_location():
+    client = StubClient(failures = [400])
+    mail = makeMails(1)[0]
+    mail.excerpt = "mail 0: the seminar is at 3pm.\nvenue: hall b"
+
+    cleo.enrichMail(mail, client)
+
+    assert client.models.calls == 1
+    assert mail.title == "Workshop 0"
+    assert mail.location == cleo.extractLocation(mail.excerpt)
+
+def test_answers_are_cached():
+    client = StubClient()
+
+    cleo.extractTitleLocation(makeMails(3), client)
+    again = makeMails(3)
+    cleo.extractTitleLocation(again, client)
+
+    assert client.models.calls == 3
+    assert again[2].title == "Title 2"
+
+def test_batched_requests():
+    client = StubClient()
+    mails = makeMails(10)
+
+    cleo.extractTitleLocation(mails, client, batched = True)
+
+    assert [mail.title for mail in mails] == [f"Title {i}" for i in range(10)]
+    assert client.models.calls == len(cleo.packMails(mails))
+
+def test_batch_misses_are_counted_once():
+    client = StubClient()
+    mails = makeMails(3)
+    # the model leaves this one out of the batched answer, it is retried on its own
+    mails[1].excerpt = mails[1].body = "mail 1 on 12 march 2025 at 3pm"
+    cache = cleo.TitleCache("titles.db")
+    answer = client.models.generate_content
+
+    def partial(model, contents, config):
+        result = json.loads(answer(model, contents, config).text)
+        result.pop('m1', None)
+        return Chunk(json.dumps(result))
+
+    client.models.generate_content = partial
+
+    cleo.enrichBatch(mails, client, cache)
+
+    assert [mail.title for mail in mails] == ["Title 0", "Title 1", "Title 2"]
+    assert (cache.hits, cache.misses) == (0, 3)
@@ -0,0 +1,40 @@
+# date and time extraction over the labelled mails in benchmarks/corpus.json
+
+import os.path
+import sys
+
+import pytest
+
+import main as cleo
+
+sys.path.insert(0, os.path.join(os.path.dirname(cleo.__file__), 'benchmarks'))
+
+import benchmark
+
+@pytest.fixture(scope = 'module')
+def corpus():
+    return benchmark.loadCorpus()
+
+def parsed(corpus):
+    return [cleo.parseMessage(benchmark.toMessage(fixture)) for fixture in corpus]
+
+def test_parallel_matches_serial(corpus):
+    serial = parsed(corpus)
+    parallel = parsed(corpus)
+
+    cleo.extractDateTime(serial)
+    # small chunks so the corpus is actually split over the workers
+    cleo.extractDateTimeParallel(parallel, workers = 2, chunkSize = 5)
+
+    for a, b in zip(serial, parallel):
+        assert [getattr(a, key) for key in cleo.DATETIME_FIELDS] == [getattr(b, key) for key in cleo.DATETIME_FIELDS], a.id
+        assert a.excerpt == b.excerpt
+
+def test_benchmark_gates_on_accuracy_only():
+    baseline = {'throughput': 1000, 'accuracy': {'startdate': 1.0}}
+    slower = {'throughput': 500, 'accuracy': {'startdate': 1.0}}
+    wrong = {'throughput': 1000, 'accuracy': {'startdate': 0.9}}
+
+    assert not benchmark.compare(slower, baseline)[1]
+    assert benchmark.compare(slower, baseline, tolerance = 0.15)[1]
+    assert benchmark.compare(wrong, baseline)[1]
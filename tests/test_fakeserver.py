@@ -0,0 +1,76 @@
+# record mode of benchmarks/fakeserver.py, with a local server standing in for google
+
+import json
+import os.path
+import sys
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import main as cleo
+
+sys.path.insert(0, os.path.join(os.path.dirname(cleo.__file__), 'benchmarks'))
+
+import fakeserver
+
+class Upstream(BaseHTTPRequestHandler):
+    # answers 200 to authorized requests and 401 to the rest, like google
+    seen = []
+
+    def do_GET(self):
+        self.seen.append(self.headers.get('Authorization'))
+        status = 200 if self.headers.get('Authorization') == 'Bearer real' else 401
+        body = json.dumps({'messages': []} if status == 200 else {'error': {'code': 401}}).encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def proxy(monkeypatch, tmp_path):
+    upstream = ThreadingHTTPServer(('127.0.0.1', 0), Upstream)
+    threading.Thread(target = upstream.serve_forever, daemon = True).start()
+    Upstream.seen = []
+
+    monkeypatch.setattr(fakeserver, 'UPSTREAMS', [('/gmail/', f"http://127.0.0.1:{upstream.server_address[1]}")])
+    server = fakeserver.startFakeServer(0, mails = 0, cassette = str(tmp_path / 'session.json'), mode = 'record')
+
+    yield server
+
+    server.shutdown()
+    upstream.shutdown()
+
+def get(server, headers):
+    url = f"http://127.0.0.1:{server.server_address[1]}/gmail/v1/users/me/messages"
+
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers = headers)) as response:
+            return response.status
+    except urllib.request.HTTPError as error:
+        return error.code
+
+def test_record_passes_the_callers_credentials_on(proxy):
+    assert get(proxy, {'Authorization': 'Bearer real'}) == 200
+    assert Upstream.seen == ['Bearer real']
+    assert proxy.cassette.tapes['GET /gmail/v1/users/me/messages'][0]['status'] == 200
+
+def test_record_turns_anonymous_requests_away(proxy):
+    assert get(proxy, {}) == 401
+    assert Upstream.seen == []
+    assert proxy.cassette.tapes == {}
+
+def test_endpoint_auth_signs_in(monkeypatch):
+    monkeypatch.setattr(cleo, 'authenticate', lambda: type('Creds', (), {'valid': False})())
+    monkeypatch.setattr(cleo, 'AnonymousCredentials', lambda: pytest.fail("anonymous credentials with --endpoint-auth"))
+    monkeypatch.setattr(cleo, 'API_ENDPOINT', None)
+    monkeypatch.setattr(cleo, 'API_ENDPOINT_AUTH', False)
+    monkeypatch.setattr('sys.argv', ['main.py', '--endpoint', 'http://127.0.0.1:8900', '--endpoint-auth'])
+
+    cleo.main()
@@ -0,0 +1,87 @@
+# batched message fetching against a stub of the gmail service
+
+import main as cleo
+
+class Request:
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+class Batch:
+
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request, request_id))
+
+    def execute(self):
+        self.service.batches.append([request_id for request, request_id in self.requests])
+
+        for request, request_id in self.requests:
+            if request.message_id in self.service.missing:
+                self.callback(request_id, None, Exception("not found"))
+            else:
+                self.callback(request_id, {'id': request.message_id}, None)
+
+class StubGmail:
+
+    def __init__(self, missing = ()):
+        self.missing = set(missing)
+        self.batches = []
+
+    def new_batch_http_request(self, callback):
+        return Batch(self, callback)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def get(self, userId, id, fields):
+        assert fields == cleo.MESSAGE_FIELDS
+        return Request(id)
+
+def test_one_request_per_batch():
+    service = StubGmail()
+    ids = [f"m{i}" for i in range(25)]
+
+    messages, failed = cleo.getMessages(service, ids, batchSize = 10)
+
+    assert [len(batch) for batch in service.batches] == [10, 10, 5]
+    assert [message['id'] for message in messages] == ids
+    assert failed == {}
+
+def test_failed_messages_are_left_out_in_order():
+    service = StubGmail(missing = {'m1', 'm3'})
+    ids = ['m4', 'm3', 'm2', 'm1', 'm0']
+
+    messages, failed = cleo.getMessages(service, ids, batchSize = 2)
+
+    assert [message['id'] for message in messages] == ['m4', 'm2', 'm0']
+    assert sorted(failed) == ['m1', 'm3']
+
+def test_rate_limited_messages_survive_the_checkpoint(monkeypatch):
+    import httplib2
+    from googleapiclient.errors import HttpError
+
+    class RateLimited(StubGmail):
+        # m2's part of the batch is answered with a 429
+        def new_batch_http_request(self, callback):
+            def answer(request_id, response, exception):
+                if request_id == 'm2':
+                    return callback(request_id, None, HttpError(httplib2.Response({'status': 429}), b''))
+                callback(request_id, response, exception)
+            return Batch(self, answer)
+
+    monkeypatch.setattr(cleo, 'getService', lambda *args: RateLimited())
+    monkeypatch.setattr(cleo, 'listNewMail', lambda service, maxResults, path: (['m1', 'm2'], '200'))
+    monkeypatch.setattr(cleo, 'parseMessage', lambda message: cleo.Mail(message['id']))
+
+    mails = cleo.syncMail(None, 10)
+
+    assert [mail.id for mail in mails] == ['m1']
+    assert cleo.loadHistoryId(cleo.HISTORY_FILE) == '200'
+    assert 'm2' in cleo.pendingIds([])
@@ -0,0 +1,47 @@
+import main as cleo
+
+def mail(subject, body, id = 'm1'):
+    return cleo.Mail(id, sender = 'friend@example.com', subject = subject, body = body)
+
+def test_dated_note_without_event_words_is_kept():
+    relevance = cleo.RelevanceFilter()
+    assert relevance.relevant(mail("Team sync moved", "moving our team sync to today at 15:00. same room as usual"))
+    assert relevance.relevant(mail("Book club", "book club meets on march 31st at 6pm at the coffee house"))
+
+def test_in_order_to_is_not_a_receipt():
+    relevance = cleo.RelevanceFilter()
+    assert relevance.score(mail("Workshop", "in order to attend the workshop please register")) == \
+           relevance.score(mail("Workshop", "to attend the workshop please register"))
+    assert not relevance.relevant(mail("Your order has shipped", "your order number 123 has shipped and will be delivered"))
+
+def test_filtered_mails_are_not_finished_or_resumed():
+    cleo.filterMails([mail("Your order has shipped", "your order number 123 has shipped", 'receipt')])
+
+    ledger = cleo.getLedger()
+    assert not ledger.finished('receipt')
+    assert ledger.unfinished() == []
+
+def test_no_filter_keeps_everything(monkeypatch):
+    monkeypatch.setattr(cleo, 'RELEVANCE_FILTER', False)
+    mails = [mail("Your order has shipped", "your order number 123 has shipped")]
+
+    assert cleo.filterMails(mails) == mails
+    assert cleo.parseArgs(['--no-filter']).filter is False
+    assert cleo.parseArgs([]).filter is True
+
+def test_skip_rate_is_kept_per_account():
+    relevance = cleo.RelevanceFilter()
+    receipt = mail("Your order has shipped", "your order number 123 has shipped")
+
+    try:
+        cleo.ACCOUNT.name = 'first'
+        relevance.relevant(receipt)
+        cleo.ACCOUNT.name = 'second'
+        relevance.relevant(receipt)
+        relevance.relevant(mail("Seminar", "seminar on 12 april 2025 at 3pm in hall b"))
+
+        assert relevance.report() == (2, 1)
+        cleo.ACCOUNT.name = 'first'
+        assert relevance.report() == (1, 1)
+    finally:
+        cleo.ACCOUNT.name = None
@@ -0,0 +1,76 @@
+from datetime import date, datetime, time, timedelta, timezone
+
+import main as cleo
+
+TZ = timezone(timedelta(hours = 5, minutes = 30))
+
+def makeMail():
+    return cleo.Mail('m1', subject = "Seminar", title = "Seminar", location = "Hall B",
+                     startdate = date(2025, 3, 12), enddate = date(2025, 3, 12), starttime = time(15), endtime = time(16))
+
+def test_resumed_mail_does_not_conflict_with_its_own_event():
+    index = cleo.CalendarIndex(None, tz = TZ)
+    index.lo, index.hi = datetime(2025, 1, 1, tzinfo = TZ), datetime(2026, 1, 1, tzinfo = TZ)
+
+    # the run that crashed had already created the event
+    first = cleo.CalendarWriter(None, index)
+    cleo.insertEvent(None, cleo.createEvent(makeMail()), '2', tz = TZ, index = index, writer = first, mail = makeMail())
+    created = dict(next(iter(first.pending.values()))[1])
+
+    index = cleo.CalendarIndex(None, tz = TZ)
+    index.lo, index.hi = first.index.lo, first.index.hi
+    index.add(created)
+
+    # keep new on the resumed mail must not delete it
+    writer = cleo.CalendarWriter(None, index)
+    cleo.insertEvent(None, cleo.createEvent(makeMail()), '2', tz = TZ, index = index, writer = writer, mail = makeMail())
+
+    assert [kind for kind, event, mail in writer.pending.values()] == ['insert']
+    assert list(writer.pending) == [created['id']]
+
+def test_unfinished_messages_are_resumed_once_per_run():
+    ledger = cleo.Ledger("ledger.db")
+    ledger.record('old', 'fetched')
+    ledger.record('done', 'done')
+
+    assert cleo.pendingIds(['new', 'done'], ledger) == ['old', 'new']
+    assert cleo.pendingIds(['next'], ledger, resume = False) == ['next']
+
+def test_old_finished_messages_are_pruned(monkeypatch):
+    ledger = cleo.Ledger("ledger.db")
+    ledger.record('old', 'done')
+    ledger.record('stuck', 'fetched')
+    ledger.db.execute("UPDATE messages SET updated = 0")
+    ledger.db.commit()
+
+    ledger = cleo.Ledger("ledger.db", maxAge = 3600)
+
+    assert not ledger.finished('old')
+    assert ledger.unfinished() == ['stuck']
+
+def test_failed_conflict_lookup_leaves_the_mail_for_the_next_run(monkeypatch):
+    import httplib2
+    from googleapiclient.errors import HttpError
+
+    index = cleo.CalendarIndex(None, tz = TZ)
+    lookups = []
+
+    def conflicts(timeMin, timeMax):
+        # the second day's window is not loaded yet and google answers 503
+        lookups.append(timeMin)
+        if len(lookups) == 2:
+            raise HttpError(httplib2.Response({'status': 503}), b'')
+        return []
+
+    monkeypatch.setattr(index, 'conflicts', conflicts)
+    writer = cleo.CalendarWriter(None, index)
+
+    mail = makeMail()
+    mail.all_dates = [date(2025, 3, 12), date(2025, 3, 13)]
+    cleo.getLedger().record(mail.id, 'extracted')
+
+    cleo.handleMail(None, mail, True, index, writer)
+
+    assert writer.pending == {}
+    assert not cleo.getLedger().finished(mail.id)
+    assert cleo.getLedger().unfinished() == [mail.id]
@@ -0,0 +1,42 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import main as cleo
+
+def test_metrics_listen_on_loopback():
+    server = cleo.startMetricsServer(0)
+
+    try:
+        assert server.server_address[0] == '127.0.0.1'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_prompts_are_not_timed(monkeypatch):
+    monkeypatch.setattr('builtins.input', lambda prompt: time.sleep(0.3) or 'y')
+    metrics = cleo.Metrics()
+
+    with metrics.timer('insert'):
+        cleo.ask("Add to calendar? [Y/n]: ")
+
+    assert metrics.cycle()['stages']['insert']['seconds'] < 0.1
+
+def test_accounts_keep_their_own_cycles():
+    process = cleo.Metrics()
+    first, second = cleo.Metrics(process, account = 'first'), cleo.Metrics(process, account = 'second')
+
+    def work(metrics, calls):
+        cleo.ACCOUNT.metrics = metrics
+        try:
+            # the gemini requests of a cycle run on the enrichment pool
+            with ThreadPoolExecutor(2) as executor:
+                list(executor.map(cleo.inAccount(lambda _: cleo.getMetrics().count('api_requests', api = 'gemini')), range(calls)))
+        finally:
+            cleo.ACCOUNT.metrics = None
+
+    work(first, 3)
+    work(second, 5)
+
+    assert first.cycle()['counters']['api_requests'] == {'api=gemini': 3}
+    assert second.cycle()['counters']['api_requests'] == {'api=gemini': 5}
+    assert 'cleo_api_requests_total{account="second",api="gemini"} 5' in process.prometheus()
@@ -0,0 +1,49 @@
+import base64
+import json
+import threading
+import urllib.request
+
+import pytest
+
+import main as cleo
+
+def notify(port, historyId, token = None):
+    # a notification the way pub/sub posts it
+    data = base64.b64encode(json.dumps({'emailAddress': 'me', 'historyId': historyId}).encode()).decode()
+    body = json.dumps({'message': {'data': data}}).encode()
+    url = f"http://127.0.0.1:{port}/" + (f"?token={token}" if token else "")
+
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data = body)) as response:
+            return response.status
+    except urllib.request.HTTPError as error:
+        return error.code
+
+def test_receiver_listens_on_loopback():
+    wake = threading.Event()
+    server = cleo.startReceiver(wake, 0)
+
+    try:
+        assert server.server_address[0] == '127.0.0.1'
+        assert notify(server.server_address[1], 10) == 204
+        assert wake.is_set()
+    finally:
+        server.shutdown()
+
+def test_token_is_checked():
+    wake = threading.Event()
+    server = cleo.startReceiver(wake, 0, token = 'secret')
+
+    try:
+        assert notify(server.server_address[1], 10) == 403
+        assert not wake.is_set()
+        assert notify(server.server_address[1], 10, 'secret') == 204
+    finally:
+        server.shutdown()
+
+def test_other_interfaces_need_a_token():
+    with pytest.raises(ValueError):
+        cleo.startReceiver(threading.Event(), 0, host = '0.0.0.0')
+
+    with pytest.raises(SystemExit):
+        cleo.parseArgs(['--push', 'projects/p/topics/t', '--push-host', '0.0.0.0'])
@@ -0,0 +1,31 @@
+import main as cleo
+
+def test_inline_tags_do_not_split_words():
+    html = '<p><b>Sem</b>inar on <i>12</i> March</p><p>Venue: <span>Hall</span> B</p>'
+    assert cleo.htmlToText(html) == 'Seminar on 12 March\nVenue: Hall B'
+
+def test_block_tags_and_cells_still_separate():
+    html = '<table><tr><td>Date</td><td>12 March</td></tr><tr><th>Time</th><td>3pm</td></tr></table>line<br>break'
+    assert cleo.htmlToText(html) == 'Date 12 March\nTime 3pm\nline\nbreak'
+
+def test_undated_reply_reads_the_quoted_date():
+    text = "see you at 5pm!\n\non mon, 3 mar 2025 at 10:02, ravi <ravi@example.org> wrote:\n> workshop on 5 march 2025 in room c7"
+    excerpt = cleo.segmentText(text)
+    assert 'see you at 5pm!' in excerpt and 'workshop on 5 march 2025 in room c7' in excerpt
+
+def test_dash_line_above_the_event_is_not_a_signature():
+    assert 'seminar on 12 april 2025' in cleo.segmentText("hi all\n--\nseminar on 12 april 2025 at 3pm in hall b")
+    assert 'member since' not in cleo.segmentText("review on 18 march 2025 at 11am.\n\n--\ndr. iyer\nmember since 2 january 2019")
+
+def test_footer_words_early_in_a_mail_are_kept():
+    text = "hello coders,\nvenue details are confidential until registration, so please register soon.\nsee you on 20 march 2025."
+    assert 'venue details' in cleo.segmentText(text)
+    assert 'unsubscribe' not in cleo.segmentText("meetup on 22 march 2025 at 5pm.\nto unsubscribe click here")
+
+def test_overlapping_dates_are_found_inside_the_match():
+    found = [(match['text'].strip(), match['pattern']) for match in cleo.scanDates("the fest runs may 2 - 5 june 2025 in hall b")]
+    assert ('2 - 5 june 2025', 0) in found
+
+    # a later date of the same kind further on is not an overlap
+    found = [match['text'].strip() for match in cleo.scanDates("may 2 - 5 in hall b, then 7 - 9 june 2025")]
+    assert found == ['may 2 - 5', '7 - 9 june 2025']